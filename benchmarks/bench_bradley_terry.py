@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Fit time of Bradley-Terry ratings, cold and warm started, against the
+    sequential Elo replay of the same matches.
+
+    $ python benchmarks/bench_bradley_terry.py --n_items 10000 \\
+        --n_matches 1000000
+"""
+import os
+import sys
+import time
+import argparse
+from typing import List, Dict, Any
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'server'))
+import bradley_terry  # noqa: E402
+from comparator import RatedMatchComparator  # noqa: E402
+
+
+def parse_arguments(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Bradley-Terry benchmark')
+    parser.add_argument('--n_items', default=10000, type=int,
+                        help='Number of items')
+    parser.add_argument('--n_matches', default=1000000, type=int,
+                        help='Number of matches')
+    parser.add_argument('--n_new', default=100, type=int,
+                        help='Matches added before the warm refit')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Random seed')
+    return parser.parse_args(argv)
+
+
+def simulate_matches(n_items: int, n_matches: int, seed: int
+                     ) -> Dict[str, np.ndarray]:
+    rng = np.random.RandomState(seed)
+    score = rng.normal(1500, 200, n_items)
+    i = rng.randint(0, n_items, n_matches)
+    j = (i + rng.randint(1, n_items, n_matches)) % n_items
+    p = 1.0 / (10 ** ((score[j] - score[i]) / 400) + 1)
+    won = rng.rand(n_matches) < p
+    return {
+        'score': score,
+        'winners': np.where(won, i, j),
+        'losers': np.where(won, j, i),
+    }
+
+
+def _rank_correlation(a: np.ndarray, b: np.ndarray) -> float:
+    return np.corrcoef(np.argsort(np.argsort(a)),
+                       np.argsort(np.argsort(b)))[0, 1]
+
+
+def _fit(winners: np.ndarray, losers: np.ndarray, n_items: int,
+         init: np.ndarray = None) -> Dict[str, Any]:
+    start = time.perf_counter()
+    games = bradley_terry.count_games(winners, losers, n_items)
+    counted = time.perf_counter()
+    rating, n_iter = bradley_terry.fit_bradley_terry(*games, init=init)
+    end = time.perf_counter()
+    return {
+        'rating': rating,
+        'count_s': counted - start,
+        'fit_s': end - counted,
+        'n_iter': n_iter,
+    }
+
+
+def _replay_elo(winners: np.ndarray, losers: np.ndarray, n_items: int
+                ) -> Dict[str, Any]:
+    rate = np.full(n_items, 1500, dtype=np.float32)
+    calc = RatedMatchComparator._calc_victory_probability
+    start = time.perf_counter()
+    for winner, loser in zip(winners.tolist(), losers.tolist()):
+        wba = calc(rate[loser] - rate[winner])
+        rate[winner] += 32 * wba
+        rate[loser] -= 32 * wba
+    return {'rating': rate, 'fit_s': time.perf_counter() - start}
+
+
+def main(argv: List[str]) -> List[Dict[str, Any]]:
+    args = parse_arguments(argv)
+    data = simulate_matches(args.n_items, args.n_matches, args.seed)
+    winners, losers = data['winners'], data['losers']
+    n_old = args.n_matches - args.n_new
+
+    cold = _fit(winners[:n_old], losers[:n_old], args.n_items)
+    warm = _fit(winners, losers, args.n_items, init=cold['rating'])
+    elo = _replay_elo(winners, losers, args.n_items)
+
+    results = [
+        dict(mode='bt-cold', n_matches=n_old, **cold),
+        dict(mode='bt-warm', n_matches=args.n_matches, **warm),
+        dict(mode='elo', n_matches=args.n_matches, count_s=0.0, n_iter=1,
+             **elo),
+    ]
+    for result in results:
+        result['rank_corr'] = _rank_correlation(data['score'],
+                                                result.pop('rating'))
+        print('%(mode)-8s %(n_matches)8d matches  count %(count_s)6.2f s'
+              '  fit %(fit_s)7.2f s  %(n_iter)4d iters'
+              '  rank corr %(rank_corr).4f' % result)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
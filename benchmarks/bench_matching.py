@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Matching methods and comparators against a simulated annotator, who
+    answers every pair from hidden scores until the items are fully ordered.
+
+    Per-pick latency percentiles, peak RSS, DB write time and the number of
+    answers are written to JSON. With `--baseline`, the results are compared
+    with those of an earlier run.
+
+    DB write time is spent in the logger while answering. With
+    `--async_commit` that only queues the rows, and the background writes
+    left at the end show in the drain time instead.
+
+    $ python benchmarks/bench_matching.py --sizes 100 1000 --output new.json \\
+        --baseline old.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import resource
+import platform
+import tempfile
+import argparse
+import subprocess
+import multiprocessing
+from typing import NoReturn, List, Dict, Any
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'server'))
+from comparator import create_comparater  # noqa: E402
+from match_result import MatchResult  # noqa: E402
+from matching import create_matching_generator  # noqa: E402
+
+METHODS = ('random', 'freq', 'rating', 'intro')
+# Matching in the server process, or in a worker over shared memory
+MATCHINGS = ('inline', 'process')
+# name -> create_comparater() arguments
+COMPARATORS = {
+    'plain': dict(rate=False),
+    'elo': dict(rate=True),
+    'pseudo': dict(rate=True, pseudo=True),
+    'bt': dict(rate=True, rating_backend='bt'),
+}
+# Rough peak bytes per n^2 items, from the match matrix and gain tables
+_BYTES_PER_PAIR = {'random': 2, 'freq': 2, 'rating': 26, 'intro': 26}
+
+
+def parse_arguments(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Matching benchmark')
+    parser.add_argument('--sizes', default=[100, 1000, 5000, 20000],
+                        type=int, nargs='+', help='Numbers of items')
+    parser.add_argument('--methods', default=list(METHODS), nargs='+',
+                        choices=METHODS, help='Matching methods')
+    parser.add_argument('--comparators', default=list(COMPARATORS),
+                        nargs='+', choices=list(COMPARATORS),
+                        help='Comparator variants')
+    parser.add_argument('--matchings', default=['inline'], nargs='+',
+                        choices=MATCHINGS,
+                        help='Run matching inline or in a worker process')
+    parser.add_argument('--max_answers', default=None, type=int,
+                        help='Stop a run after this many answers')
+    parser.add_argument('--time_limit', default=600.0, type=float,
+                        help='Stop a run after this many seconds')
+    parser.add_argument('--max_memory_mb', default=None, type=float,
+                        help='Skip runs estimated to need more memory '
+                             '(default: available memory)')
+    parser.add_argument('--async_commit', action='store_true',
+                        help='Commit from a background writer')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Random seed')
+    parser.add_argument('--output', '-o', default='bench_matching.json',
+                        help='Path to JSON results')
+    parser.add_argument('--baseline', default=None,
+                        help='Path to JSON results to compare with')
+    return parser.parse_args(argv)
+
+
+def _get_peak_rss_mb(pid: str = 'self') -> float:
+    # VmHWM starts over on exec, while ru_maxrss is kept from the parent
+    try:
+        with open('/proc/%s/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _get_available_mb() -> float:
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float('inf')
+
+
+def _get_revision() -> str:
+    try:
+        return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _percentiles_ms(values: List[float]) -> Dict[str, float]:
+    if len(values) == 0:
+        return None
+    p50, p90, p99 = np.percentile(values, (50, 90, 99)) * 1e3
+    return {'p50': p50, 'p90': p90, 'p99': p99,
+            'max': np.max(values) * 1e3}
+
+
+def _time_calls(obj: Any, name: str, sink: List[float]) -> NoReturn:
+    fn = getattr(obj, name)
+
+    def timed(*args: Any, **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            sink.append(time.perf_counter() - start)
+
+    setattr(obj, name, timed)
+
+
+def _is_ordered(match_result: np.ndarray, scores: np.ndarray) -> bool:
+    # In a full order an item beats exactly the items scored below it
+    wins = np.count_nonzero(match_result == MatchResult.WIN, axis=1)
+    return np.array_equal(wins, np.argsort(np.argsort(scores)))
+
+
+def _get_worker_peak_rss_mb(matching: Any) -> float:
+    executor = getattr(matching, '_executor', None)
+    if executor is None:
+        return None
+    return sum(_get_peak_rss_mb(pid) for pid in executor._processes)
+
+
+def run(method: str, comparator_name: str, matching_name: str,
+        n_items: int, max_answers: int, time_limit: float,
+        async_commit: bool, seed: int) -> Dict[str, Any]:
+    """ One simulated annotation session, in its own process. """
+    random.seed(seed)
+    np.random.seed(seed)
+    scores = np.random.permutation(n_items)
+    process = matching_name == 'process'
+
+    with tempfile.TemporaryDirectory() as dirname:
+        start = time.perf_counter()
+        comparator = create_comparater(
+                n_items, os.path.join(dirname, 'bench.db'), shared=process,
+                db_options=dict(persistent=True, async_commit=async_commit),
+                **COMPARATORS[comparator_name])
+        matching = create_matching_generator(comparator, method, process)
+        setup_s = time.perf_counter() - start
+
+        writes = list()
+        for name in ('add', 'close', 'flush'):
+            _time_calls(comparator._logger, name, writes)
+
+        picks, answers = list(), list()
+        finished = False
+        start = time.perf_counter()
+        while max_answers is None or len(answers) < max_answers:
+            if time.perf_counter() - start > time_limit:
+                break
+
+            pick_start = time.perf_counter()
+            try:
+                i, j = next(matching)
+            except StopIteration:
+                finished = True
+                break
+            answer_start = time.perf_counter()
+            picks.append(answer_start - pick_start)
+
+            if scores[i] > scores[j]:
+                comparator.set_match_result(i, j)
+            else:
+                comparator.set_match_result(j, i)
+            answers.append(time.perf_counter() - answer_start)
+        elapsed = time.perf_counter() - start
+        write_s = sum(writes)
+        worker_peak_rss_mb = _get_worker_peak_rss_mb(matching)
+        matching.close()
+
+        # Waits for the background writer, if any
+        start = time.perf_counter()
+        comparator.close()
+        drain_s = time.perf_counter() - start
+
+        return {
+            'method': method,
+            'comparator': comparator_name,
+            'matching': matching_name,
+            'n_items': n_items,
+            'n_answers': len(answers),
+            'finished': finished,
+            'ordered': finished and _is_ordered(comparator.match_result,
+                                                scores),
+            'n_finished': int(comparator.n_finished),
+            'n_match': comparator.n_match,
+            'setup_s': setup_s,
+            'elapsed_s': elapsed,
+            'pick_ms': _percentiles_ms(picks),
+            'answer_ms': _percentiles_ms(answers),
+            'db_write_s': write_s,
+            'db_drain_s': drain_s,
+            'peak_rss_mb': _get_peak_rss_mb(),
+            'worker_peak_rss_mb': worker_peak_rss_mb,
+        }
+
+
+def _send_run(conn: Any, args: tuple) -> NoReturn:
+    conn.send(run(*args))
+    conn.close()
+
+
+def _run_isolated(ctx: Any, args: tuple) -> Dict[str, Any]:
+    # Not a pool, as the worker process of matching cannot be started from
+    # a daemonic process
+    receiver, sender = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_send_run, args=(sender, args))
+    proc.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    finally:
+        proc.join()
+
+
+def _is_supported(method: str, comparator_name: str) -> bool:
+    # Rating based methods need rated comparators
+    return COMPARATORS[comparator_name]['rate'] or \
+        method in ('random', 'freq')
+
+
+def _estimate_mb(method: str, n_items: int) -> float:
+    return _BYTES_PER_PAIR[method] * n_items ** 2 / 1024 ** 2
+
+
+def _key(result: Dict[str, Any]) -> tuple:
+    return (result['method'], result['comparator'],
+            result.get('matching', 'inline'), result['n_items'])
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]]
+            ) -> NoReturn:
+    baseline = {_key(result): result for result in baseline}
+    for result in results:
+        old = baseline.get(_key(result))
+        if old is None or 'skipped' in old or 'skipped' in result or \
+           not (result['pick_ms'] and old['pick_ms']):
+            continue
+        print('%-7s %-7s %-7s %6d  answers %+7.1f%%  pick p50 %+7.1f%%'
+              '  p99 %+7.1f%%  peak RSS %+7.1f%%' % (
+                  *_key(result),
+                  _change(old['n_answers'], result['n_answers']),
+                  _change(old['pick_ms']['p50'], result['pick_ms']['p50']),
+                  _change(old['pick_ms']['p99'], result['pick_ms']['p99']),
+                  _change(old['peak_rss_mb'], result['peak_rss_mb'])))
+
+
+def _change(old: float, new: float) -> float:
+    return (new - old) / old * 100 if old else 0.0
+
+
+def _print(result: Dict[str, Any]) -> NoReturn:
+    if 'skipped' in result:
+        print('%-7s %-7s %-7s %6d  skipped: %s' % (*_key(result),
+                                                   result['skipped']))
+        return
+    pick = result['pick_ms'] or dict(p50=0, p99=0)
+    print('%-7s %-7s %-7s %6d  %8d answers%s  pick p50 %8.2f ms'
+          '  p99 %8.2f ms  DB %7.2f s + %5.2f s  peak RSS %8.1f MB' % (
+              *_key(result), result['n_answers'],
+              ' ' if result['ordered'] else '*', pick['p50'], pick['p99'],
+              result['db_write_s'], result['db_drain_s'],
+              result['peak_rss_mb'] + (result['worker_peak_rss_mb'] or 0)))
+
+
+def main(argv: List[str]) -> List[Dict[str, Any]]:
+    args = parse_arguments(argv)
+    max_memory_mb = args.max_memory_mb or _get_available_mb()
+
+    # A fresh process per run keeps the peak RSS apart
+    ctx = multiprocessing.get_context('spawn')
+    results = list()
+    runs = [(method, comparator_name, matching_name, n_items)
+            for n_items in args.sizes
+            for method in args.methods
+            for comparator_name in args.comparators
+            for matching_name in args.matchings
+            if _is_supported(method, comparator_name)]
+    for method, comparator_name, matching_name, n_items in runs:
+        result = dict(method=method, comparator=comparator_name,
+                      matching=matching_name, n_items=n_items)
+        estimate = _estimate_mb(method, n_items)
+        if estimate > max_memory_mb:
+            result['skipped'] = 'needs about %d MB' % estimate
+        else:
+            result = _run_isolated(ctx, (
+                    method, comparator_name, matching_name, n_items,
+                    args.max_answers, args.time_limit, args.async_commit,
+                    args.seed))
+        _print(result)
+        results.append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'revision': _get_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'args': vars(args),
+            'results': results,
+        }, f, indent=2)
+    if not all(result.get('ordered', True) for result in results):
+        print('(* not fully ordered within the limits)')
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(results, json.load(f)['results'])
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Thumbnail latency and peak RSS of the full-resolution decode against the
+    reduced-resolution decode.
+
+    $ python benchmarks/bench_thumbnail.py --width 6000 --height 4000
+"""
+import os
+import sys
+import time
+import resource
+import tempfile
+import argparse
+import multiprocessing
+from typing import List, Dict, Any
+
+import numpy as np
+import cv2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'server'))
+import thumbnail  # noqa: E402
+
+
+def parse_arguments(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Thumbnail benchmark')
+    parser.add_argument('--width', default=6000, type=int,
+                        help='Width of the generated photos')
+    parser.add_argument('--height', default=4000, type=int,
+                        help='Height of the generated photos')
+    parser.add_argument('--n_images', default=8, type=int,
+                        help='Number of generated photos')
+    parser.add_argument('--max_size', default=400, type=int,
+                        help='Thumbnail image size')
+    return parser.parse_args(argv)
+
+
+def create_images(dirname: str, n_images: int, width: int, height: int
+                  ) -> List[str]:
+    # Smooth gradients with noise compress like photos
+    y, x = np.mgrid[:height, :width]
+    base = np.stack(((x * 255 // width), (y * 255 // height),
+                     ((x + y) * 255 // (width + height))), axis=2)
+    names = list()
+    for i in range(n_images):
+        noise = np.random.randint(0, 32, base.shape)
+        name = os.path.join(dirname, '%d.jpg' % i)
+        cv2.imwrite(name, (base + noise).astype(np.uint8))
+        names.append(name)
+    return names
+
+
+def _full_decode(filename: str, max_size: int) -> bytes:
+    img = thumbnail._load_image(filename)
+    img = thumbnail._resize_image(img, max_size)
+    return cv2.imencode('.jpg', img)[1].tobytes()
+
+
+def _get_peak_rss_mb() -> float:
+    # VmHWM starts over on exec, while ru_maxrss is kept from the parent
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run(mode: str, names: List[str], max_size: int) -> Dict[str, Any]:
+    fn = _full_decode if mode == 'full' else thumbnail.create_thumbnail
+    latencies = list()
+    for name in names:
+        start = time.perf_counter()
+        fn(name, max_size)
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        'mode': mode,
+        'median_ms': np.median(latencies) * 1e3,
+        'max_ms': np.max(latencies) * 1e3,
+        'peak_rss_mb': _get_peak_rss_mb(),
+    }
+
+
+def main(argv: List[str]) -> List[Dict[str, Any]]:
+    args = parse_arguments(argv)
+
+    with tempfile.TemporaryDirectory() as dirname:
+        names = create_images(dirname, args.n_images, args.width, args.height)
+        # A fresh process per mode keeps the peak RSS apart
+        ctx = multiprocessing.get_context('spawn')
+        results = list()
+        for mode in ('full', 'reduced'):
+            with ctx.Pool(1) as pool:
+                results.append(pool.apply(_run, (mode, names,
+                                                 args.max_size)))
+
+    for result in results:
+        print('%(mode)-8s median %(median_ms)8.2f ms  max %(max_ms)8.2f ms'
+              '  peak RSS %(peak_rss_mb)8.1f MB' % result)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
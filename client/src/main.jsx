@@ -7,6 +7,11 @@ import Header from './header.jsx';
 import 'bootstrap/dist/css/bootstrap.min.css';
 
 
+const pairKey = (id1, id2) => {
+  return [id1, id2].sort((a, b) => a - b).join('-');
+};
+
+
 class App extends React.Component {
 
   constructor(props) {
@@ -22,6 +27,51 @@ class App extends React.Component {
     this.handleSelect = this.handleSelect.bind(this);
     this.handleUndo = this.handleUndo.bind(this);
     this.websocket = null;
+    this.preloaded = [];
+
+    // Batch mode: pairs received but not shown yet, and the shown one
+    this.queue = [];
+    this.current = null;
+  }
+
+  showNext() {
+    this.current = this.queue.shift() || null;
+    this.setState(this.current ? {
+      disabled: false,
+      target1: this.current.target[0],
+      target2: this.current.target[1],
+    } : {
+      disabled: true,
+      target1: {},
+      target2: {},
+    });
+  }
+
+  receiveBatch(data) {
+    const dropped = new Set(data.drop.map((pair) => {
+      return pairKey(pair[0], pair[1]);
+    }));
+    const isKept = (pair) => {
+      return !dropped.has(pairKey(pair.target[0].id, pair.target[1].id));
+    };
+
+    this.queue = this.queue.filter(isKept).concat(data.pairs);
+    this.setState({
+      now: data.matches.finished,
+      total: data.matches.total,
+    });
+    if (this.current === null || !isKept(this.current)) {
+      this.showNext();
+    }
+  }
+
+  preload(urls) {
+    // Thumbnails served by URL land in the browser cache before use
+    this.preloaded = (urls || []).map((url) => {
+      const img = new Image();
+      img.src = url;
+      return img;
+    });
   }
 
   componentDidMount() {
@@ -29,6 +79,11 @@ class App extends React.Component {
 
     this.websocket.onmessage = (res) => {
       const data = JSON.parse(res.data);
+      this.preload(data.upcoming);
+      if (data.pairs !== undefined) {
+        this.receiveBatch(data);
+        return;
+      }
       this.setState({
         disabled: false,
         now: data.matches.finished,
@@ -41,21 +96,30 @@ class App extends React.Component {
 
   handleSelect({winner, loser}) {
     if (!this.state.disabled) {
-      this.setState({
-        disabled: true,
-        target1: {},
-        target2: {},
-      });
       this.websocket.send(JSON.stringify({
         action: 'select',
         loser: loser,
         winner: winner,
       }));
+      if (this.current !== null) {
+        // Answers are streamed, the next pair is already here
+        this.showNext();
+        return;
+      }
+      this.setState({
+        disabled: true,
+        target1: {},
+        target2: {},
+      });
     }
   }
 
   handleUndo() {
     if (!this.state.disabled) {
+      if (this.current !== null) {
+        this.queue.unshift(this.current);
+        this.current = null;
+      }
       this.setState({
         disabled: true,
         target1: {},
@@ -73,7 +137,7 @@ class App extends React.Component {
         <Header
           now={this.state.now}
           total={this.state.total}
-          onClick={this.state.handleUndo}
+          onClick={this.handleUndo}
         />
         <MainView
           target1={this.state.target1}
@@ -91,6 +91,7 @@ class MainView extends React.Component {
 
 }
 
+// `src` is a base64 data URI or a cacheable `/thumb/<id>/<size>` URL
 MainView.propTypes = {
   disabled: PropTypes.bool,
   target1: PropTypes.shape({
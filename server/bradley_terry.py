@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import threading
+from typing import NoReturn, Tuple, List, Any
+
+import numpy as np
+from nptyping import NDArray
+
+from match_result import MatchResult
+
+# Logging
+from logging import getLogger, NullHandler
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())
+
+
+def count_games(winners: NDArray[int], losers: NDArray[int], n_items: int
+                ) -> Tuple[NDArray[int], NDArray[int], NDArray[int],
+                           NDArray[int]]:
+    """ Wins of each item, and the sparse game counts of each unordered pair
+        as (i, j, n_games).
+    """
+    winners = np.asarray(winners, dtype=np.int64)
+    losers = np.asarray(losers, dtype=np.int64)
+    wins = np.bincount(winners, minlength=n_items)
+    keys = np.minimum(winners, losers) * n_items + \
+        np.maximum(winners, losers)
+    keys, n_games = np.unique(keys, return_counts=True)
+    i, j = np.divmod(keys, n_items)
+    return wins, i, j, n_games
+
+
+def fit_bradley_terry(wins: NDArray[int], i: NDArray[int], j: NDArray[int],
+                      n_games: NDArray[int], init: NDArray[float] = None,
+                      prior: float = 1.0, tol: float = 0.01,
+                      max_iter: int = 1000) -> Tuple[NDArray[float], int]:
+    """ Bradley-Terry ratings on the Elo scale by MM iterations (Hunter,
+        2004), and the number of iterations.
+
+        Every item also wins and loses `prior` games against a virtual item
+        rated 1500, which keeps unbeaten and winless items finite and fixes
+        the scale. Iterations stop when no rating moves by `tol` points.
+    """
+    n_items = len(wins)
+    wins = wins + prior
+    if init is None:
+        # Win ratios are close to the solution and halve the iterations
+        losses = np.bincount(i, n_games, n_items) + \
+            np.bincount(j, n_games, n_items) - wins + 2 * prior
+        strength = wins / losses
+    else:
+        strength = 10 ** ((np.asarray(init, dtype=np.float64) - 1500) / 400)
+
+    for n_iter in range(1, max_iter + 1):
+        games = n_games / (strength[i] + strength[j])
+        denom = 2 * prior / (strength + 1)
+        denom += np.bincount(i, games, n_items)
+        denom += np.bincount(j, games, n_items)
+
+        new_strength = wins / denom
+        change = np.max(np.abs(np.log10(new_strength / strength)))
+        strength = new_strength
+        if change * 400 < tol:
+            break
+
+    return 1500 + 400 * np.log10(strength), n_iter
+
+
+class BradleyTerryFitter():
+    """ Refit Bradley-Terry ratings on every decided pair in a background
+        thread, starting from the previous solution.
+
+        Comparator notifications are only queued, and `pop_rating` returns
+        the latest finished fit, so the caller decides when ratings change.
+    """
+    def __init__(self, n_items: int, prior: float = 1.0, tol: float = 0.01,
+                 background: bool = True):
+        self._n_items = n_items
+        self._prior = prior
+        self._tol = tol
+        self._winners = np.empty(0, dtype=np.int64)
+        self._losers = np.empty(0, dtype=np.int64)
+        self._rating = None
+        self._fitted = None
+
+        # Updates are queued by the caller and merged by the fitting thread
+        self._updates = list()
+        self._lock = threading.Lock()
+        self._fit_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._run,
+                                            name='bradley-terry',
+                                            daemon=True)
+            self._thread.start()
+
+    def load(self, match_result: NDArray[(Any, Any), int]) -> NoReturn:
+        """ Start over from the decided pairs of `match_result`. """
+        winners, losers = np.nonzero(match_result == MatchResult.WIN)
+        with self._fit_lock:
+            with self._lock:
+                self._updates = list()
+            self._winners = winners.astype(np.int64)
+            self._losers = losers.astype(np.int64)
+
+    def update(self, winners: NDArray[int], losers: NDArray[int],
+               resolved: bool) -> NoReturn:
+        with self._lock:
+            self._updates.append((np.asarray(winners, dtype=np.int64),
+                                  np.asarray(losers, dtype=np.int64),
+                                  resolved))
+        self._wakeup.set()
+
+    def _merge(self, updates: List[Tuple[NDArray[int], NDArray[int], bool]]
+               ) -> NoReturn:
+        for winners, losers, resolved in updates:
+            if resolved:
+                self._winners = np.concatenate((self._winners, winners))
+                self._losers = np.concatenate((self._losers, losers))
+                continue
+            removed = np.isin(self._winners * self._n_items + self._losers,
+                              winners * self._n_items + losers)
+            self._winners = self._winners[~removed]
+            self._losers = self._losers[~removed]
+
+    def refit(self) -> NDArray[float]:
+        """ Fit on every update so far and return the ratings. """
+        with self._fit_lock:
+            with self._lock:
+                updates, self._updates = self._updates, list()
+            self._merge(updates)
+
+            games = count_games(self._winners, self._losers, self._n_items)
+            rating, n_iter = fit_bradley_terry(*games, init=self._rating,
+                                               prior=self._prior,
+                                               tol=self._tol)
+            logger.debug('Fitted %d matches in %d iterations.',
+                         len(self._winners), n_iter)
+            with self._lock:
+                self._rating = rating
+                self._fitted = rating
+            return rating
+
+    def pop_rating(self) -> NDArray[float]:
+        """ Ratings fitted since the last call, or None. """
+        with self._lock:
+            rating, self._fitted = self._fitted, None
+            return rating
+
+    def _run(self) -> NoReturn:
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._closed:
+                return
+            try:
+                self.refit()
+            except Exception as e:
+                logger.error('Failed to fit ratings: %s', e)
+
+    def close(self) -> NoReturn:
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
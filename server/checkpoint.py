@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import os
+import glob
+from typing import NoReturn, Dict, Any
+
+import numpy as np
+
+# Logging
+from logging import getLogger, NullHandler
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())
+
+
+class Checkpoint():
+    """ Snapshot of comparator state stored next to the database.
+
+        `<db>.ckpt.npz` holds small arrays and the name of the matrix file
+        `<db>.ckpt-<last_id>.npy`, which is memory-mapped on load.
+    """
+    def __init__(self, db_path: str, interval: int = 100):
+        self._prefix = '%s.ckpt' % db_path
+        self._interval = interval
+        self._n_steps = 0
+        self._last_id = None
+
+    @property
+    def _state_path(self) -> str:
+        return '%s.npz' % self._prefix
+
+    @property
+    def last_id(self) -> int:
+        return self._last_id
+
+    def step(self) -> bool:
+        self._n_steps += 1
+        return self._interval > 0 and self._n_steps % self._interval == 0
+
+    def load(self) -> Dict[str, Any]:
+        if not os.path.exists(self._state_path):
+            return None
+
+        try:
+            with np.load(self._state_path) as npz:
+                state = {key: npz[key] for key in npz.files}
+            dirname = os.path.dirname(self._state_path)
+            result_path = os.path.join(dirname, str(state.pop('result_file')))
+            # Copy-on-write keeps the file intact while the matrix changes
+            state['result'] = np.load(result_path, mmap_mode='c')
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning('Failed to load checkpoint: %s', e)
+            return None
+
+        state['last_id'] = state['last_id'].item()
+        state['current_match'] = state['current_match'].item()
+        self._last_id = state['last_id']
+        logger.info('Load checkpoint at match %d.', self._last_id)
+        return state
+
+    def save(self, last_id: int, **arrays: Any) -> NoReturn:
+        result_path = '%s-%d.npy' % (self._prefix, last_id)
+        result = arrays.pop('result')
+        with open('%s.tmp' % result_path, 'wb') as f:
+            np.save(f, result)
+        os.replace('%s.tmp' % result_path, result_path)
+
+        with open('%s.tmp' % self._state_path, 'wb') as f:
+            np.savez(f, last_id=last_id,
+                     result_file=os.path.basename(result_path), **arrays)
+        os.replace('%s.tmp' % self._state_path, self._state_path)
+
+        self._last_id = last_id
+        self._remove_stale(keep=result_path)
+        logger.info('Save checkpoint at match %d.', last_id)
+
+    def invalidate(self) -> NoReturn:
+        if os.path.exists(self._state_path):
+            os.remove(self._state_path)
+            logger.info('Invalidate checkpoint at match %d.', self._last_id)
+        self._last_id = None
+        self._remove_stale()
+
+    def _remove_stale(self, keep: str = None) -> NoReturn:
+        for path in glob.glob('%s-*.npy' % glob.escape(self._prefix)):
+            if path != keep:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
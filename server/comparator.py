@@ -1,22 +1,73 @@
 # -*- coding: utf-8 -*-
-from typing import NoReturn, Tuple, List, Any
+from contextlib import contextmanager
+from typing import NoReturn, Tuple, List, Dict, Iterator, Callable, Any
 
 import numpy as np
 from nptyping import NDArray
 
 import db
-from match_result import MatchResult
+from bradley_terry import BradleyTerryFitter
+from checkpoint import Checkpoint
+from shared import SharedState, Handle
+from match_result import MatchResult, MATCH_RESULT_DTYPE
+
+# Logging
+from logging import getLogger, NullHandler
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())
+
+
+def _to_columns(matches: List[Dict[str, Any]], *keys: str
+                ) -> List[NDArray[Any]]:
+    dtype = None if len(matches) > 0 else int
+    return [np.asarray([match.get(key) for match in matches], dtype=dtype)
+            for key in keys]
+
+
+def replay_rating(rate: NDArray[float], columns: Dict[str, NDArray[Any]],
+                  calc_victory_probability: Callable[[float], float]
+                  ) -> NoReturn:
+    # Logged rates are taken before each match, so the current rating of an
+    # item follows from its last match only. Chunks arrive in id order, so
+    # later chunks overwrite earlier ones.
+    winners, losers = columns['winner'], columns['loser']
+    winner_rates = columns['winner_rate']
+    loser_rates = columns['loser_rate']
+
+    wba = calc_victory_probability(loser_rates - winner_rates)
+    items = np.stack((winners, losers), axis=1).ravel()
+    rates = np.stack((winner_rates + 32 * wba, loser_rates - 32 * wba),
+                     axis=1).ravel()
+    items, last = np.unique(items[::-1], return_index=True)
+    rate[items] = rates[::-1][last]
 
 
 class MatchComparator():
-    def __init__(self, n_items: int, logger: db.MatchResultDBController):
-        self._result = np.full((n_items, n_items), MatchResult.NONE)
-        self._result[range(n_items), range(n_items)] = MatchResult.DRAW
+    _CHUNK_SIZE = 65536
+
+    def __init__(self, n_items: int, logger: db.MatchResultDBController,
+                 checkpoint: Checkpoint = None, shared: bool = False):
+        self._shared = SharedState() if shared else None
+        self._version = 0
+        self._init_state(n_items)
         self._trigger_id = set()
         self._current_match = 1
+        self._listeners = list()
         self._logger = logger
+        self._checkpoint = checkpoint
         self._load_log()
 
+    def _allocate(self, name: str, shape: Tuple[int, ...], dtype: Any,
+                  fill: Any) -> NDArray[Any]:
+        if self._shared is None:
+            return np.full(shape, fill, dtype=dtype)
+        return self._shared.allocate(name, shape, dtype, fill)
+
+    def _init_state(self, n_items: int) -> NoReturn:
+        self._result = self._allocate('result', (n_items, n_items),
+                                      MATCH_RESULT_DTYPE, MatchResult.NONE)
+        self._result[range(n_items), range(n_items)] = MatchResult.DRAW
+
     @property
     def n_match(self) -> int:
         n_result = self._result.shape[0]
@@ -34,83 +85,241 @@ class MatchComparator():
         result.flags.writeable = False
         return result
 
-    def _load_log(self) -> NoReturn:
-        matches = self._logger.get(ordered=True)
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def shared_handles(self) -> Dict[str, Handle]:
+        if self._shared is None:
+            return None
+        return self._shared.handles
+
+    def close(self) -> NoReturn:
+        # Waits for queued asynchronous commits
+        self._logger.dispose()
+        if self._shared is not None:
+            self._shared.close()
+
+    def _publish_version(self) -> NoReturn:
+        self._version += 1
+        if self._shared is not None:
+            self._shared.publish(self._version)
+
+    @contextmanager
+    def _updating(self) -> Iterator[None]:
+        # Odd versions mark an update in progress for shared readers, and
+        # the version is even again even if the update fails
+        self._publish_version()
+        try:
+            yield
+        finally:
+            self._publish_version()
+
+    def add_listener(self, listener: Callable[[NDArray[int], NDArray[int],
+                                               bool], NoReturn]) -> NoReturn:
+        self._listeners.append(listener)
+
+    def _notify(self, winners: NDArray[int], losers: NDArray[int],
+                resolved: bool) -> NoReturn:
+        for listener in self._listeners:
+            listener(winners, losers, resolved)
+
+    def _get_state(self) -> Dict[str, Any]:
+        trigger_ids = [tid for tid in self._trigger_id if tid is not None]
+        return {
+            'result': self._result,
+            'trigger_id': np.asarray(sorted(trigger_ids), dtype=int),
+            'current_match': self._current_match,
+        }
+
+    def _restore_state(self, state: Dict[str, Any]) -> NoReturn:
+        result = state['result']
+        if result.shape == self._result.shape and self._shared is None:
+            self._result = result
+        else:
+            # New items were added after the checkpoint
+            n_items = result.shape[0]
+            self._result[:n_items, :n_items] = result
+        self._trigger_id = set(state['trigger_id'].tolist())
+        self._current_match = state['current_match']
+
+    def _load_checkpoint(self) -> int:
+        if self._checkpoint is None:
+            return None
 
-        for match in matches:
-            winner, loser = match.get('winner'), match.get('loser')
-            self._result[winner, loser] = MatchResult.WIN
-            self._result[loser, winner] = MatchResult.LOSE
-            self._trigger_id.add(match.get('trigger_id'))
+        state = self._checkpoint.load()
+        if state is None:
+            return None
 
-        if len(matches) > 0:
-            self._current_match = matches[-1].get('id') + 1
+        last_id = self._logger.current_id
+        if state['result'].shape[0] > self._result.shape[0] or \
+           state['last_id'] > last_id:
+            self._checkpoint.invalidate()
+            return None
+
+        self._restore_state(state)
+        return state['last_id']
+
+    def save_checkpoint(self) -> NoReturn:
+        if self._checkpoint is not None:
+            self._checkpoint.save(self._current_match - 1, **self._get_state())
+
+    def _load_log(self) -> NoReturn:
+        start_id = self._load_checkpoint()
+        for columns in self._logger.iter_columns(start_id=start_id,
+                                                 chunk_size=self._CHUNK_SIZE):
+            self._replay(columns)
+            self._current_match = columns['id'][-1].item() + 1
+
+    def _replay(self, columns: Dict[str, NDArray[Any]]) -> NoReturn:
+        winners, losers = columns['winner'], columns['loser']
+        trigger_ids = columns['trigger_id']
+        self._result[winners, losers] = MatchResult.WIN
+        self._result[losers, winners] = MatchResult.LOSE
+        self._trigger_id.update(trigger_ids[trigger_ids >= 0].tolist())
 
     def _get_transitive_results(self, winner: int, loser: int
-                                ) -> List[Tuple[int]]:
-        transitive_winners = np.where(
-                (self._result[winner] == MatchResult.LOSE) &
-                (self._result[loser] == MatchResult.NONE)
-        )
-        transitive_losers = np.where(
-                (self._result[winner] == MatchResult.NONE) &
-                (self._result[loser] == MatchResult.WIN)
-        )
-        return [(twinner, loser) for twinner in transitive_winners[0]] + \
-               [(winner, tloser) for tloser in transitive_losers[0]]
-
-    def _set_match_result(self, winner: int, loser: int,
-                          trigger_id: int) -> NoReturn:
+                                ) -> Tuple[NDArray[int], NDArray[int]]:
         if self._result[winner, loser] != MatchResult.NONE:
-            return
-
-        self._result[winner, loser] = MatchResult.WIN
-        self._result[loser, winner] = MatchResult.LOSE
-        self._logger.add(match_ids=self._current_match,
-                         winners=winner,
-                         losers=loser,
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+        # The matrix is transitively closed, so every new result is
+        # (item beating the winner) > (item losing to the loser).
+        ancestors = np.append(
+                winner, np.where(self._result[winner] == MatchResult.LOSE)[0])
+        descendants = np.append(
+                loser, np.where(self._result[loser] == MatchResult.WIN)[0])
+        undecided = self._result[np.ix_(ancestors, descendants)] == \
+            MatchResult.NONE
+        i, j = np.nonzero(undecided)
+        return ancestors[i], descendants[j]
+
+    def _set_match_results(self, winners: NDArray[int], losers: NDArray[int],
+                           trigger_id: int) -> NoReturn:
+        match_ids = np.arange(self._current_match,
+                              self._current_match + len(winners))
+        self._result[winners, losers] = MatchResult.WIN
+        self._result[losers, winners] = MatchResult.LOSE
+        self._logger.add(match_ids=match_ids,
+                         winners=winners,
+                         losers=losers,
                          trigger_ids=trigger_id)
-        self._current_match += 1
+        self._current_match += len(winners)
 
-    def set_match_result(self, winner: int, loser: int) -> NoReturn:
-        trigger_id = self._current_match
-        self._trigger_id.add(trigger_id)
+    def _get_backup(self, winners: NDArray[int], losers: NDArray[int]
+                    ) -> Dict[str, Any]:
+        return {'current_match': self._current_match}
 
-        with self._logger:
-            self._set_match_result(winner, loser, trigger_id)
+    def _restore_backup(self, winners: NDArray[int], losers: NDArray[int],
+                        backup: Dict[str, Any]) -> NoReturn:
+        self._result[winners, losers] = MatchResult.NONE
+        self._result[losers, winners] = MatchResult.NONE
+        self._current_match = backup['current_match']
 
-            transitive_results = self._get_transitive_results(winner, loser)
-            while len(transitive_results) > 0:
-                new_transitive_results = list()
-                for (twinner, tloser) in transitive_results:
-                    self._set_match_result(twinner, tloser, trigger_id)
-                    new_transitive_results.extend(
-                            self._get_transitive_results(twinner, tloser))
-                transitive_results = new_transitive_results
+    def set_match_result(self, winner: int, loser: int) -> int:
+        """ Id to undo the answer with, or None if nothing was decided. """
+        trigger_id = self._current_match
+        winners, losers = self._get_transitive_results(winner, loser)
+        if len(winners) == 0:
+            # Already decided, e.g. answered twice; nothing to undo later
+            return None
+        backup = self._get_backup(winners, losers)
+        with self._updating():
+            try:
+                with self._logger:
+                    self._set_match_results(winners, losers, trigger_id)
+            except BaseException:
+                # Not logged, so not decided either
+                self._restore_backup(winners, losers, backup)
+                raise
+        self._trigger_id.add(trigger_id)
 
-    def strip_match_result(self) -> NoReturn:
-        strip_id = max(self._trigger_id)
+        self._notify(winners, losers, True)
+
+        if self._checkpoint is not None and self._checkpoint.step():
+            self.save_checkpoint()
+        return trigger_id
+
+    def _invalidate_checkpoint(self, strip_id: int) -> NoReturn:
+        if self._checkpoint is not None and \
+           self._checkpoint.last_id is not None and \
+           strip_id <= self._checkpoint.last_id:
+            self._checkpoint.invalidate()
+
+    def _is_depended_on(self, trigger_id: int) -> bool:
+        # A later answer on an item of this one may have been completed with
+        # results inferred from it
+        n_items = self._result.shape[0]
+        own = np.zeros(n_items, dtype=bool)
+        later = np.zeros(n_items, dtype=bool)
+        for columns in self._logger.iter_columns(start_id=trigger_id - 1,
+                                                 chunk_size=self._CHUNK_SIZE):
+            is_own = columns['trigger_id'] == trigger_id
+            for key in ('winner', 'loser'):
+                own[columns[key][is_own]] = True
+                later[columns[key][~is_own]] = True
+        return bool(np.any(own & later))
+
+    def _get_strip_id(self, trigger_id: int) -> int:
+        if len(self._trigger_id) == 0:
+            return None
+        last_id = max(self._trigger_id)
+        if trigger_id is None or trigger_id == last_id:
+            return last_id
+        if trigger_id not in self._trigger_id:
+            return None
+        if self._is_depended_on(trigger_id):
+            logger.warning('Answer %d is followed by related answers.',
+                           trigger_id)
+            return None
+        return trigger_id
+
+    def strip_match_result(self, trigger_id: int = None) -> bool:
+        """ Undo the answer `trigger_id` with the results inferred from it,
+            by default the last answer. An earlier answer is kept if later
+            ones share its items. Returns whether it was undone.
+        """
+        strip_id = self._get_strip_id(trigger_id)
+        if strip_id is None:
+            return False
+        self._invalidate_checkpoint(strip_id)
 
         with self._logger:
             matches = self._logger.delete(strip_id)
 
-        for match in matches:
-            winner, loser = match.get('winner'), match.get('loser')
-            self._result[(winner, loser), (loser, winner)] = MatchResult.NONE
+        winners, losers = _to_columns(matches, 'winner', 'loser')
+        with self._updating():
+            self._result[winners, losers] = MatchResult.NONE
+            self._result[losers, winners] = MatchResult.NONE
 
         self._trigger_id.remove(strip_id)
         self._current_match = self._logger.current_id + 1
+        self._notify(winners, losers, False)
+        return True
 
 
 class RatedMatchComparator(MatchComparator):
-    def __init__(self, n_items: int, logger: db.RatedMatchResultDBController):
-        self._result = np.full((n_items, n_items), MatchResult.NONE)
-        self._result[range(n_items), range(n_items)] = MatchResult.DRAW
-        self._rate = np.full((n_items,), 1500, dtype=np.float32)
-        self._trigger_id = set()
-        self._current_match = 1
-        self._logger = logger
-        self._load_log()
+    """ Ratings follow sequential Elo updates, or with `fitter`, Bradley-Terry
+        fits of every decided pair. Fits run in the background and are
+        applied at the next update.
+    """
+    def __init__(self, n_items: int, logger: db.RatedMatchResultDBController,
+                 simulate: bool = False, checkpoint: Checkpoint = None,
+                 shared: bool = False, fitter: BradleyTerryFitter = None):
+        self._simulate = simulate
+        self._fitter = fitter
+        super().__init__(n_items, logger, checkpoint, shared)
+
+        if fitter is not None:
+            fitter.load(self._result)
+            self._rate[:] = fitter.refit()
+            fitter.pop_rating()
+            self.add_listener(fitter.update)
+
+    def _init_state(self, n_items: int) -> NoReturn:
+        super()._init_state(n_items)
+        self._rate = self._allocate('rate', (n_items,), np.float32, 1500)
 
     @property
     def rating(self) -> NDArray[(Any), float]:
@@ -118,76 +327,150 @@ class RatedMatchComparator(MatchComparator):
         rate.flags.writeable = False
         return rate
 
-    def _calc_victory_probability(self, rate_diff: float) -> float:
+    @staticmethod
+    def _calc_victory_probability(rate_diff: float) -> float:
         return 1.0 / (10 ** (-rate_diff * 0.0025) + 1)
 
+    def close(self) -> NoReturn:
+        if self._fitter is not None:
+            self._fitter.close()
+        super().close()
+
+    def _apply_fitted_rating(self) -> NoReturn:
+        if self._fitter is None:
+            return
+        rating = self._fitter.pop_rating()
+        if rating is not None:
+            with self._updating():
+                self._rate[:] = rating
+
     def _update_rating(self, winner: int, loser: int) -> NoReturn:
+        if self._fitter is not None:
+            return
         rate_diff = self._rate[loser] - self._rate[winner]
         wba = self._calc_victory_probability(rate_diff)
         self._rate[winner] += 32 * wba
         self._rate[loser] -= 32 * wba
 
-    def _load_log(self) -> NoReturn:
-        matches = self._logger.get(ordered=True)
-
-        for match in matches:
-            winner, loser = match.get('winner'), match.get('loser')
-            self._result[winner, loser] = MatchResult.WIN
-            self._result[loser, winner] = MatchResult.LOSE
-            self._trigger_id.add(match.get('trigger_id'))
-            self._update_rating(winner, loser)
+    def _get_state(self) -> Dict[str, Any]:
+        state = super()._get_state()
+        state['rate'] = self._rate
+        return state
 
-        if len(matches) > 0:
-            self._current_match = matches[-1].get('id') + 1
+    def _restore_state(self, state: Dict[str, Any]) -> NoReturn:
+        super()._restore_state(state)
+        self._rate[:len(state['rate'])] = state['rate']
 
-    def _set_match_result(self, winner: int, loser: int,
-                          trigger_id: int) -> NoReturn:
-        if self._result[winner, loser] != MatchResult.NONE:
+    def _replay(self, columns: Dict[str, NDArray[Any]]) -> NoReturn:
+        super()._replay(columns)
+        if self._fitter is not None:
+            # Fitted on the whole result after loading
+            return
+        if self._simulate:
+            winners, losers = columns['winner'], columns['loser']
+            for winner, loser in zip(winners.tolist(), losers.tolist()):
+                self._update_rating(winner, loser)
             return
 
-        self._result[winner, loser] = MatchResult.WIN
-        self._result[loser, winner] = MatchResult.LOSE
-        self._logger.add(match_ids=self._current_match,
-                         winners=winner,
-                         losers=loser,
+        replay_rating(self._rate, columns, self._calc_victory_probability)
+
+    def _get_backup(self, winners: NDArray[int], losers: NDArray[int]
+                    ) -> Dict[str, Any]:
+        backup = super()._get_backup(winners, losers)
+        items = np.union1d(winners, losers)
+        backup['items'], backup['rate'] = items, self._rate[items].copy()
+        return backup
+
+    def _restore_backup(self, winners: NDArray[int], losers: NDArray[int],
+                        backup: Dict[str, Any]) -> NoReturn:
+        super()._restore_backup(winners, losers, backup)
+        self._rate[backup['items']] = backup['rate']
+
+    def _set_match_results(self, winners: NDArray[int], losers: NDArray[int],
+                           trigger_id: int) -> NoReturn:
+        match_ids = np.arange(self._current_match,
+                              self._current_match + len(winners))
+        winner_rates = np.empty(len(winners), dtype=self._rate.dtype)
+        loser_rates = np.empty(len(losers), dtype=self._rate.dtype)
+
+        # Elo updates depend on the order, so only the ratings are sequential
+        for i, (winner, loser) in enumerate(zip(winners, losers)):
+            winner_rates[i] = self._rate[winner]
+            loser_rates[i] = self._rate[loser]
+            self._update_rating(winner, loser)
+
+        self._result[winners, losers] = MatchResult.WIN
+        self._result[losers, winners] = MatchResult.LOSE
+        self._logger.add(match_ids=match_ids,
+                         winners=winners,
+                         losers=losers,
                          trigger_ids=trigger_id,
-                         winner_rates=self._rate[winner],
-                         loser_rates=self._rate[loser])
-        self._update_rating(winner, loser)
+                         winner_rates=winner_rates,
+                         loser_rates=loser_rates)
+        self._current_match += len(winners)
 
-        self._current_match += 1
+    def set_match_result(self, winner: int, loser: int) -> int:
+        self._apply_fitted_rating()
+        return super().set_match_result(winner, loser)
 
-    def strip_match_result(self) -> NoReturn:
-        strip_id = max(self._trigger_id)
+    def strip_match_result(self, trigger_id: int = None) -> bool:
+        strip_id = self._get_strip_id(trigger_id)
+        if strip_id is None:
+            return False
+        self._invalidate_checkpoint(strip_id)
 
         with self._logger:
             matches = self._logger.delete(strip_id)
 
-        for match in matches[::-1]:
-            winner, loser = match.get('winner'), match.get('loser')
-            wrate, lrate = match.get('winner_rate'), match.get('loser_rate')
-            self._result[(winner, loser), (loser, winner)] = MatchResult.NONE
-            self._rate[winner] = wrate
-            self._rate[loser] = lrate
+        self._apply_fitted_rating()
+        with self._updating():
+            for match in matches[::-1]:
+                winner, loser = match.get('winner'), match.get('loser')
+                wrate = match.get('winner_rate')
+                lrate = match.get('loser_rate')
+                self._result[(winner, loser), (loser, winner)] = \
+                    MatchResult.NONE
+                self._rate[winner] = wrate
+                self._rate[loser] = lrate
 
         self._trigger_id.remove(strip_id)
         self._current_match = self._logger.current_id + 1
 
+        winners, losers = _to_columns(matches, 'winner', 'loser')
+        self._notify(winners, losers, False)
+        return True
+
 
 class PseudoRatedMatchComparator(RatedMatchComparator):
-    def _calc_victory_probability(self, rate_diff: float) -> float:
+    @staticmethod
+    def _calc_victory_probability(rate_diff: float) -> float:
         return rate_diff * 0.00125 + 0.5
 
 
 def create_comparater(n_items: int, db_path: str,
-                      rate: bool = True, pseudo: bool = False)\
-                      -> MatchComparator:
+                      rate: bool = True, pseudo: bool = False,
+                      simulate: bool = False, checkpoint_interval: int = 0,
+                      shared: bool = False, db_options: Dict[str, Any] = None,
+                      rating_backend: str = 'elo') -> MatchComparator:
+    checkpoint = None
+    if checkpoint_interval > 0:
+        checkpoint = Checkpoint(db_path, checkpoint_interval)
+
     if rate:
-        logger = db.RatedMatchResultDBController(db_path)
+        logger = db.RatedMatchResultDBController(db_path,
+                                                 **(db_options or dict()))
+        fitter = None
+        if rating_backend == 'bt':
+            fitter = BradleyTerryFitter(n_items)
+        elif rating_backend != 'elo':
+            raise ValueError('Unknown rating backend: %s' % rating_backend)
+
         if pseudo:
-            return PseudoRatedMatchComparator(n_items, logger)
+            return PseudoRatedMatchComparator(n_items, logger, simulate,
+                                              checkpoint, shared, fitter)
         else:
-            return RatedMatchComparator(n_items, logger)
+            return RatedMatchComparator(n_items, logger, simulate, checkpoint,
+                                        shared, fitter)
 
-    logger = db.MatchResultDBController(db_path)
-    return MatchComparator(n_items, logger)
+    logger = db.MatchResultDBController(db_path, **(db_options or dict()))
+    return MatchComparator(n_items, logger, checkpoint, shared)
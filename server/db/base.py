@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+from typing import NoReturn
+
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import registry as orm_registry
 from sqlalchemy.orm.decl_api import DeclarativeMeta
 
@@ -7,3 +10,12 @@ class Base(metaclass=DeclarativeMeta):
     __abstract__ = True
     registry = orm_registry()
     metadata = registry.metadata
+
+
+def create_schema(engine: Engine) -> NoReturn:
+    Base.metadata.create_all(engine)
+    # `create_all` skips the indexes of existing tables, so databases from
+    # older versions get them here
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
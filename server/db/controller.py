@@ -1,50 +1,186 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 from abc import ABCMeta, abstractmethod
-from typing import NoReturn, List, Dict, Any, Tuple, Union
-from functools import reduce
-from collections.abc import Iterable
+import queue
+import threading
+from typing import NoReturn, Iterator, List, Dict, Tuple, Any, Union
 
-from sqlalchemy import create_engine, select
+from sqlalchemy import create_engine, event, select, insert, delete, bindparam
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import functions as F
 import numpy as np
 from nptyping import NDArray
 
-from .base import Base
+from .base import create_schema
 from .match_result import MatchResult
 from .rate import Rate
 from .item_label import ItemLabel
 
-
-def _dress_params(*args: List[Any], **kwargs: Dict[Any]) ->\
-            Tuple[List[NDArray[Any]], Dict[NDArray[Any]]]:
-    """ Padding shorter argument with None.
+# Logging
+from logging import getLogger, NullHandler
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())
+
+
+# Hot queries are built once. SQLAlchemy caches their compiled forms and a
+# reused sqlite3 connection caches the prepared statements.
+_MAX_MATCH_ID = select(F.max(MatchResult.id))
+_MATCHES = select(MatchResult.id, MatchResult.winner, MatchResult.loser,
+                  MatchResult.triggered_by)
+_RATED_MATCHES = select(MatchResult.id, MatchResult.winner, MatchResult.loser,
+                        MatchResult.triggered_by, Rate.winner_rate,
+                        Rate.loser_rate).\
+    join(Rate, MatchResult.id == Rate.match_id)
+# Columnar reads coalesce a missing trigger into -1 to keep integer columns
+_MATCH_COLUMNS = select(MatchResult.id, MatchResult.winner, MatchResult.loser,
+                        F.coalesce(MatchResult.triggered_by, -1))
+_RATED_MATCH_COLUMNS = _MATCH_COLUMNS.add_columns(Rate.winner_rate,
+                                                  Rate.loser_rate).\
+    join(Rate, MatchResult.id == Rate.match_id)
+_TRIGGERED = MatchResult.triggered_by == bindparam('trigger_id')
+_DELETE_MATCHES = delete(MatchResult).where(_TRIGGERED).\
+    execution_options(synchronize_session=False)
+_DELETE_RATES = delete(Rate).\
+    where(Rate.match_id.in_(select(MatchResult.id).where(_TRIGGERED))).\
+    execution_options(synchronize_session=False)
+
+
+def _dress_columns(**columns: Union[Any, NDArray[Any]]
+                   ) -> List[Dict[str, Any]]:
+    """ Build executemany parameters from columns. Scalars are broadcast and
+        shorter sequences are padded with None.
+    """
+    columns = {k: np.asarray(v) for k, v in columns.items()}
+    lengths = [len(v) for v in columns.values() if v.ndim > 0]
+    n_rows = max(lengths) if len(lengths) > 0 else 1
+
+    values = [[v.item()] * n_rows if v.ndim == 0 else
+              v.tolist() + [None] * (n_rows - len(v))
+              for v in columns.values()]
+    return [dict(zip(columns.keys(), row)) for row in zip(*values)]
+
+
+def _create_engine(url: str, pragmas: Dict[str, Any], persistent: bool,
+                   pool_size: int = 1) -> Engine:
+    if persistent:
+        engine = create_engine(url, poolclass=QueuePool, pool_size=pool_size,
+                               max_overflow=0,
+                               connect_args={'check_same_thread': False})
+    else:
+        engine = create_engine(url)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection: Any, _: Any) -> NoReturn:
+        cursor = dbapi_connection.cursor()
+        for key, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (key, value))
+        cursor.close()
+
+    return engine
+
+
+class _AsyncWriter():
+    """ Background thread committing queued insert batches together every
+        `flush_interval` seconds. At most `max_lag` transactions wait in the
+        queue, after which writers block.
     """
-    max_len = reduce(
-                lambda x, l: max(x, len(l))
-                if isinstance(l, Iterable) and not isinstance(l, str) else x,
-                [*args, *kwargs.values()], 1
-            )
-
-    args = [np.asarray([*arg, *[None] * (max_len - len(arg))])
-            if isinstance(arg, Iterable) and not isinstance(arg, str)
-            else np.asarray([arg] * max_len)
-            for arg in args]
-    kwargs = {k: np.asarray([*arg, *[None] * (max_len - len(arg))])
-              if isinstance(arg, Iterable) and not isinstance(arg, str)
-              else np.asarray([arg] * max_len)
-              for k, arg in kwargs.items()}
-    return args, kwargs
+    def __init__(self, engine: Engine, flush_interval: float, max_lag: int):
+        self._engine = engine
+        self._interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_lag)
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, batch: List[Tuple[Any, List[Dict[str, Any]]]]
+            ) -> NoReturn:
+        if self._queue.full():
+            self._wakeup.set()
+        self._queue.put(batch)
+
+    def flush(self) -> NoReturn:
+        self._wakeup.set()
+        self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def stop(self) -> NoReturn:
+        self._stopped = True
+        self.flush()
+        self._thread.join()
+        self._engine.dispose()
+
+    def _run(self) -> NoReturn:
+        while True:
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+
+            batches = list()
+            while not self._queue.empty():
+                batches.append(self._queue.get_nowait())
+            self._write(batches)
+            for _ in batches:
+                self._queue.task_done()
+
+            if self._stopped and self._queue.empty():
+                return
+
+    def _write(self, batches: List[List[Tuple[Any, List[Dict[str, Any]]]]]
+               ) -> NoReturn:
+        if len(batches) == 0:
+            return
+        try:
+            with self._engine.begin() as conn:
+                for batch in batches:
+                    for table, rows in batch:
+                        conn.execute(insert(table), rows)
+        except Exception as e:
+            logger.error('Failed to write %d transactions: %s',
+                         len(batches), e)
+            self._error = e
 
 
 class SimpleDBController(metaclass=ABCMeta):
+    """ `with controller:` scopes one transaction, which is committed when
+        the outermost block exits. In persistent mode the session and its
+        pooled connections are kept open between transactions.
+
+        With `async_commit`, inserts are handed to a background writer when
+        the transaction exits. Every read and delete waits for the writer
+        first, so undo always sees the rows in flight.
+    """
     _BASE_URL = 'sqlite+pysqlite:///%s'
 
-    def __init__(self, db_path: str):
-        self._engine = create_engine(self._BASE_URL % db_path)
+    def __init__(self, db_path: str, persistent: bool = False,
+                 pool_size: int = 1, wal: bool = False,
+                 synchronous: str = None, cache_size: int = None,
+                 async_commit: bool = False, flush_interval: float = 0.5,
+                 max_lag: int = 64):
+        pragmas = dict()
+        if wal:
+            pragmas['journal_mode'] = 'WAL'
+        if synchronous is not None:
+            pragmas['synchronous'] = synchronous
+        if cache_size is not None:
+            pragmas['cache_size'] = -cache_size  # KiB
+
+        url = self._BASE_URL % db_path
+        self._engine = _create_engine(url, pragmas, persistent, pool_size)
+        self._persistent = persistent
         self._session = None
-        Base.metadata.create_all(self._engine)
+        self._depth = 0
+        self._pending = list()
+        self._writer = None
+        create_schema(self._engine)
+
+        if async_commit:
+            self._writer = _AsyncWriter(_create_engine(url, pragmas, True),
+                                        flush_interval, max_lag)
 
     def __enter__(self) -> SimpleDBController:
         return self.open()
@@ -53,25 +189,62 @@ class SimpleDBController(metaclass=ABCMeta):
         self.close()
 
     def open(self) -> SimpleDBController:
-        self._session = Session(self._engine, future=True)
+        if self._session is None:
+            self._session = Session(self._engine, future=True)
+        self._depth += 1
         return self
 
     def close(self) -> NoReturn:
+        self._depth -= 1
+        if self._depth > 0:
+            return
+
+        if len(self._pending) > 0:
+            self._writer.put(self._pending)
+            self._pending = list()
         self._session.commit()
-        self._session.close()
-        self._session = None
+        if not self._persistent:
+            self._session.close()
+            self._session = None
+
+    def flush(self) -> NoReturn:
+        if self._writer is None:
+            return
+        if len(self._pending) > 0:
+            self._writer.put(self._pending)
+            self._pending = list()
+        self._writer.flush()
+
+    def dispose(self) -> NoReturn:
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer = None
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        self._engine.dispose()
+
+    def _insert(self, table: Any, rows: List[Dict[str, Any]]) -> NoReturn:
+        if len(rows) == 0:
+            return
+        if self._writer is None:
+            self._session.execute(insert(table), rows)
+        else:
+            self._pending.append((table, rows))
 
     @abstractmethod
     def add(self, **kwargs) -> NoReturn:
         raise NotImplementedError
 
-    def get(self, ordered: bool = False) -> List[Dict[Any]]:
+    def get(self, ordered: bool = False, start_id: int = None
+            ) -> List[Dict[Any]]:
+        self.flush()
         with self:
-            data = self._get(ordered)
+            data = self._get(ordered, start_id)
         return data
 
     @abstractmethod
-    def _get(self, ordered: bool) -> List[Dict[Any]]:
+    def _get(self, ordered: bool, start_id: int) -> List[Dict[Any]]:
         raise NotImplementedError
 
     @abstractmethod
@@ -79,68 +252,81 @@ class SimpleDBController(metaclass=ABCMeta):
         raise NotImplementedError
 
 
-class MatchResultDBController(SimpleDBController):
+class _ColumnarDBController(SimpleDBController):
+    """ Adds `iter_columns`, which streams the match log in id order as
+        chunks of numpy columns instead of a list of dicts.
+    """
+    _COLUMNS = (('id', int), ('winner', int), ('loser', int),
+                ('trigger_id', int))
+    _COLUMNS_STMT = _MATCH_COLUMNS
+
     @property
     def current_id(self) -> int:
+        self.flush()
         with self:
-            stmt = select(F.max(MatchResult.id))
-            return self._session.execute(stmt).scalars().one()
+            return self._session.execute(_MAX_MATCH_ID).scalar() or 0
+
+    def iter_columns(self, start_id: int = None, chunk_size: int = 65536
+                     ) -> Iterator[Dict[str, NDArray[Any]]]:
+        stmt = self._COLUMNS_STMT
+        if start_id is not None:
+            stmt = stmt.filter(MatchResult.id > start_id)
+        stmt = stmt.order_by(MatchResult.id)
 
+        self.flush()
+        with self:
+            # A Core execution fetches from the cursor lazily, while an ORM
+            # one buffers every row first
+            result = self._session.connection().execute(stmt)
+            for rows in result.partitions(chunk_size):
+                values = zip(*rows)
+                yield {key: np.asarray(column, dtype=dtype)
+                       for (key, dtype), column in zip(self._COLUMNS, values)}
+
+
+class MatchResultDBController(_ColumnarDBController):
     def add(self, match_ids: Union[int, NDArray[int]],
             winners: Union[int, NDArray[int]],
             losers: Union[int, NDArray[int]],
             trigger_ids: Union[int, NDArray[int]]
             ) -> NoReturn:
 
-        args, _ = _dress_params(match_ids, winners, losers, trigger_ids)
-
-        for id, winner, loser, triggered_by in zip(*args):
-            match = MatchResult(id=id.item(),
-                                winner=winner.item(),
-                                loser=loser.item(),
-                                triggered_by=triggered_by.item())
-            self._session.add(match)
-
-    def _get(self, ordered: bool) -> List[Dict[Any]]:
-        stmt = select(MatchResult)
+        rows = _dress_columns(id=match_ids, winner=winners, loser=losers,
+                              triggered_by=trigger_ids)
+        self._insert(MatchResult, rows)
+
+    @staticmethod
+    def _to_dict(row: Any) -> Dict[Any]:
+        return {
+            'id': row.id,
+            'winner': row.winner,
+            'loser': row.loser,
+            'trigger_id': row.triggered_by,
+        }
+
+    def _get(self, ordered: bool, start_id: int) -> List[Dict[Any]]:
+        stmt = _MATCHES
+        if start_id is not None:
+            stmt = stmt.filter(MatchResult.id > start_id)
         if ordered:
             stmt = stmt.order_by(MatchResult.id)
-        result = self._session.execute(stmt).scalars().all()
-        return [
-            {
-                'id': row.id,
-                'winner': row.winner,
-                'loser': row.loser,
-                'trigger_id': row.triggered_by,
-            }
-            for row in result
-        ]
+        result = self._session.execute(stmt)
+        return [self._to_dict(row) for row in result]
 
     def delete(self, triger_id: int) -> List[Dict[Any]]:
-        stmt = select(MatchResult).\
-               filter_by(triggered_by=triger_id).\
-               order_by(MatchResult.id)
-        matches = self._session.execute(stmt).scalars().all()
-
-        deleted = list()
-        for match in matches:
-            self._session.delete(match)
-            deleted.append({
-                'id': match.id,
-                'winner': match.winner,
-                'loser': match.loser,
-                'trigger_id': match.triggered_by,
-            })
-
+        self.flush()
+        params = {'trigger_id': triger_id}
+        stmt = _MATCHES.where(_TRIGGERED).order_by(MatchResult.id)
+        deleted = [self._to_dict(row)
+                   for row in self._session.execute(stmt, params)]
+        self._session.execute(_DELETE_MATCHES, params)
         return deleted
 
 
-class RatedMatchResultDBController(SimpleDBController):
-    @property
-    def current_id(self) -> int:
-        with self:
-            stmt = select(F.max(MatchResult.id))
-            return self._session.execute(stmt).scalars().one()
+class RatedMatchResultDBController(_ColumnarDBController):
+    _COLUMNS = _ColumnarDBController._COLUMNS + (('winner_rate', float),
+                                                 ('loser_rate', float))
+    _COLUMNS_STMT = _RATED_MATCH_COLUMNS
 
     def add(self, match_ids: Union[int, NDArray[int]],
             winners: Union[int, NDArray[int]],
@@ -148,73 +334,54 @@ class RatedMatchResultDBController(SimpleDBController):
             trigger_ids: Union[int, NDArray[int]],
             winner_rates: Union[float, NDArray[float]],
             loser_rates: Union[float, NDArray[float]]) -> NoReturn:
-        args, _ = _dress_params(match_ids, winners, losers, trigger_ids,
-                                winner_rates, loser_rates)
-
-        for id, winner, loser, trigger, win_rate, lose_rate in zip(*args):
-            match = MatchResult(id=id.item(),
-                                winner=winner.item(),
-                                loser=loser.item(),
-                                triggered_by=trigger.item())
-            rate = Rate(match_id=id.item(),
-                        winner_rate=win_rate.item(),
-                        loser_rate=lose_rate.item())
-            self._session.add(match)
-            self._session.add(rate)
-
-    def _get(self, ordered: bool) -> List[Dict[Any]]:
-        stmt = select(MatchResult, Rate).\
-                join(Rate, MatchResult.id == Rate.match_id)
+        matches = _dress_columns(id=match_ids, winner=winners, loser=losers,
+                                 triggered_by=trigger_ids)
+        rates = _dress_columns(match_id=match_ids, winner_rate=winner_rates,
+                               loser_rate=loser_rates)
+        self._insert(MatchResult, matches)
+        self._insert(Rate, rates)
+
+    @staticmethod
+    def _to_dict(row: Any) -> Dict[Any]:
+        return {
+            'id': row.id,
+            'winner': row.winner,
+            'loser': row.loser,
+            'trigger_id': row.triggered_by,
+            'winner_rate': row.winner_rate,
+            'loser_rate': row.loser_rate,
+        }
+
+    def _get(self, ordered: bool, start_id: int) -> List[Dict[Any]]:
+        stmt = _RATED_MATCHES
+        if start_id is not None:
+            stmt = stmt.filter(MatchResult.id > start_id)
         if ordered:
             stmt = stmt.order_by(MatchResult.id)
-        result = self._session.execute(stmt).all()
-        return [
-            {
-                'id': match.id,
-                'winner': match.winner,
-                'loser': match.loser,
-                'trigger_id': match.triggered_by,
-                'winner_rate': rate.winner_rate,
-                'loser_rate': rate.loser_rate,
-            }
-            for (match, rate) in result
-        ]
-
-    def delete(self, trigger_id: int) -> NoReturn:
-        stmt = select(MatchResult, Rate).\
-            filter_by(triggered_by=trigger_id).\
-            join(Rate, MatchResult.id == Rate.match_id).\
-            order_by(MatchResult.id)
-
         result = self._session.execute(stmt)
-
-        deleted = list()
-        for (match, rate) in result:
-            self._session.delete(match)
-            self._session.delete(rate)
-            deleted.append({
-                'id': match.id,
-                'winner': match.winner,
-                'loser': match.loser,
-                'trigger_id': match.triggered_by,
-                'winner_rate': rate.winner_rate,
-                'loser_rate': rate.loser_rate,
-            })
-
+        return [self._to_dict(row) for row in result]
+
+    def delete(self, trigger_id: int) -> List[Dict[Any]]:
+        self.flush()
+        params = {'trigger_id': trigger_id}
+        stmt = _RATED_MATCHES.where(_TRIGGERED).order_by(MatchResult.id)
+        deleted = [self._to_dict(row)
+                   for row in self._session.execute(stmt, params)]
+        self._session.execute(_DELETE_RATES, params)
+        self._session.execute(_DELETE_MATCHES, params)
         return deleted
 
 
 class ItemLabelDBController(SimpleDBController):
     def add(self, item_ids: Union[int, NDArray[int]],
             labels: Union[str, NDArray[str]]) -> NoReturn:
-        args, _ = _dress_params(item_ids, labels)
-
-        for id, label in zip(*args):
-            item = ItemLabel(id=id.item(), label=label.item())
-            self._session.add(item)
+        rows = _dress_columns(id=item_ids, label=labels)
+        self._insert(ItemLabel, rows)
 
-    def _get(self, ordered: bool) -> List[Dict[Any]]:
+    def _get(self, ordered: bool, start_id: int) -> List[Dict[Any]]:
         stmt = select(ItemLabel)
+        if start_id is not None:
+            stmt = stmt.filter(ItemLabel.id > start_id)
         if ordered:
             stmt = stmt.order_by(ItemLabel.id)
         items = self._session.execute(stmt).scalars().all()
@@ -227,6 +394,7 @@ class ItemLabelDBController(SimpleDBController):
         ]
 
     def delete(self, label: str) -> NoReturn:
+        self.flush()
         stmt = select(ItemLabel).\
                filter_by(label=label).\
                order_by(ItemLabel.id)
@@ -8,4 +8,4 @@ class ItemLabel(Base):
     __tablename__ = 'item_label'
 
     id = Column(Integer, autoincrement=True, primary_key=True)
-    label = Column(String)
+    label = Column(String, index=True)
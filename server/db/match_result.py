@@ -10,7 +10,7 @@ class MatchResult(Base):
     id = Column(Integer, primary_key=True)
     winner = Column(Integer, nullable=False)
     loser = Column(Integer, nullable=False)
-    triggered_by = Column(Integer, nullable=True)
+    triggered_by = Column(Integer, nullable=True, index=True)
 
 
 MATCH_RESULT_PRIMARY_KEY = '%s.id' % MatchResult.__tablename__
@@ -2,17 +2,23 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import csv
 import glob
 import argparse
-from typing import List
+from typing import NoReturn, List
 
 import numpy as np
 
-from db import ItemLabelDBController
+from db import ItemLabelDBController, MatchResultDBController, \
+               RatedMatchResultDBController
 from server import start_server
-from comparator import create_comparater
+from comparator import create_comparater, RatedMatchComparator, \
+                       PseudoRatedMatchComparator
 from matching import create_matching_generator
 from response import ImageResponseIterator
+from ranking import RankingEngine
+from scheduler import PairScheduler
+from thumbnail import ThumbnailCache, MIME_TYPES, precompute_thumbnails
 
 # Logging
 from logging import getLogger, INFO
@@ -37,11 +43,141 @@ def parse_arguments(argv: List[str]) -> argparse.Namespace:
                         help='Port no')
     parser.add_argument('--pseudo', action='store_true',
                         help='Use pseudo rating')
+    parser.add_argument('--simulate_rating', action='store_true',
+                        help='Re-simulate ratings from the whole log on start')
+    parser.add_argument('--rating_backend', default='elo',
+                        choices=('elo', 'bt'),
+                        help='Sequential Elo updates or Bradley-Terry fits '
+                             'refitted in the background')
+    parser.add_argument('--checkpoint_interval', default=100, type=int,
+                        help='Annotations between state checkpoints '
+                             '(0 to disable)')
+    parser.add_argument('--db_pool_size', default=1, type=int,
+                        help='Number of pooled DB connections kept open')
+    parser.add_argument('--db_wal', action='store_true',
+                        help='Use WAL journaling with synchronous=NORMAL')
+    parser.add_argument('--db_cache_size', default=None, type=int,
+                        help='SQLite page cache size in KiB')
+    parser.add_argument('--async_commit', action='store_true',
+                        help='Commit annotations from a background writer')
+    parser.add_argument('--flush_interval', default=0.5, type=float,
+                        help='Seconds between background commits')
+    parser.add_argument('--max_lag', default=64, type=int,
+                        help='Annotations queued before writes block')
+    parser.add_argument('--matching_process', action='store_true',
+                        help='Run matching in a worker process over '
+                             'shared memory')
+    parser.add_argument('--protocol', default='inline',
+                        choices=ImageResponseIterator.PROTOCOLS,
+                        help='Send thumbnails inline as base64 or as '
+                             'cacheable /thumb URLs')
+    parser.add_argument('--lease_timeout', default=300.0, type=float,
+                        help='Seconds a pair stays leased to an annotator')
+    parser.add_argument('--batch_size', default=1, type=int,
+                        help='Pairs queued on each client (1 to answer '
+                             'one pair at a time)')
+    parser.add_argument('--server_workers', default=1, type=int,
+                        help='Threads running matching and thumbnails '
+                             'off the IOLoop')
     parser.add_argument('--max_size', '--size', '-s', default=400, type=int,
                         help='Thumbnail image size')
+    parser.add_argument('--thumbnail_cache_mb', default=64, type=int,
+                        help='Memory budget of the thumbnail cache in MB')
+    parser.add_argument('--thumbnail_dir', default=None,
+                        help='Directory of cached thumbnails '
+                             '(default: <output>.thumbs)')
+    parser.add_argument('--thumbnail_format', default='jpg',
+                        choices=sorted(MIME_TYPES),
+                        help='Image format of thumbnails')
+    parser.add_argument('--prefetch', default=4, type=int,
+                        help='Candidate pairs whose thumbnails are made '
+                             'ahead (0 to disable)')
     return parser.parse_args(argv)
 
 
+def parse_precompute_arguments(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+            prog='main.py precompute-thumbnails',
+            description='Write thumbnails of every image to the cache')
+    parser.add_argument('--input_dir', '--input', '-i', required=True,
+                        help='Path to input image directory')
+    parser.add_argument('--output', '-o', default='ranking.db',
+                        help='Path to compared result output')
+    parser.add_argument('--thumbnail_dir', default=None,
+                        help='Directory of cached thumbnails '
+                             '(default: <output>.thumbs)')
+    parser.add_argument('--sizes', '--size', '-s', default=[400], type=int,
+                        nargs='+', help='Thumbnail image sizes')
+    parser.add_argument('--thumbnail_format', default='jpg',
+                        choices=sorted(MIME_TYPES),
+                        help='Image format of thumbnails')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='Number of processes (default: all cores)')
+    return parser.parse_args(argv)
+
+
+def precompute(argv: List[str]) -> NoReturn:
+    args = parse_precompute_arguments(argv)
+    names = sorted(glob.glob(os.path.join(args.input_dir, '*.jpg')))
+    dirname = args.thumbnail_dir or '%s.thumbs' % args.output
+
+    logger.info('Precompute thumbnails of %d images in %s', len(names),
+                dirname)
+    stats = precompute_thumbnails(names, args.sizes, dirname,
+                                  args.thumbnail_format, args.workers)
+    logger.info('Created %d thumbnails of %d images in %.1f s '
+                '(%.1f images/s)', stats['n_created'], stats['n_images'],
+                stats['elapsed'], stats['images_per_sec'])
+
+
+def parse_rank_arguments(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+            prog='main.py rank',
+            description='Write the image ranking from compared results')
+    parser.add_argument('--output', '-o', default='ranking.db',
+                        help='Path to compared result output')
+    parser.add_argument('--rank_output', '-r', default=None,
+                        help='Path to ranking CSV (default: stdout)')
+    parser.add_argument('--pseudo', action='store_true',
+                        help='Ratings were made with pseudo rating')
+    return parser.parse_args(argv)
+
+
+def open_match_log(db_path: str) -> MatchResultDBController:
+    rated = RatedMatchResultDBController(db_path)
+    rows = rated.iter_columns(chunk_size=1)
+    has_rates = next(rows, None) is not None
+    rows.close()
+    return rated if has_rates else MatchResultDBController(db_path)
+
+
+def rank(argv: List[str]) -> NoReturn:
+    args = parse_rank_arguments(argv)
+    items = ItemLabelDBController(args.output).get(ordered=True)
+    labels = {item.get('id'): item.get('label') for item in items}
+    n_items = max(labels) + 1 if len(labels) > 0 else 0
+
+    comparator_cls = PseudoRatedMatchComparator if args.pseudo \
+        else RatedMatchComparator
+    engine = RankingEngine.from_log(n_items, open_match_log(args.output),
+                                    comparator_cls)
+    wins, rating = engine.wins, engine.rating
+
+    f = open(args.rank_output, 'w', newline='') \
+        if args.rank_output else sys.stdout
+    try:
+        writer = csv.writer(f)
+        writer.writerow(('rank', 'id', 'label', 'wins', 'rating'))
+        for i, idx in enumerate(engine.order.tolist(), 1):
+            if idx in labels:
+                writer.writerow((i, idx, labels[idx], wins[idx],
+                                 '%.2f' % rating[idx]))
+    finally:
+        if f is not sys.stdout:
+            f.close()
+    logger.info('Ranked %d images.', len(labels))
+
+
 def load_filenames(db_path: str, dirname: str) -> List[str]:
     db = ItemLabelDBController(db_path)
     items = db.get(ordered=True)
@@ -68,17 +204,48 @@ def load_filenames(db_path: str, dirname: str) -> List[str]:
 
 
 def main(argv):
+    if len(argv) > 0 and argv[0] == 'precompute-thumbnails':
+        return precompute(argv[1:])
+    if len(argv) > 0 and argv[0] == 'rank':
+        return rank(argv[1:])
+
     args = parse_arguments(argv)
     names = load_filenames(args.output, args.input_dir)
 
     comparator = create_comparater(len(names), args.output,
                                    args.method in ('rating', 'intro'),
-                                   args.pseudo)
-    matching = create_matching_generator(comparator, args.method)
+                                   args.pseudo, args.simulate_rating,
+                                   args.checkpoint_interval,
+                                   args.matching_process,
+                                   dict(persistent=True,
+                                        pool_size=args.db_pool_size,
+                                        wal=args.db_wal,
+                                        synchronous=('NORMAL' if args.db_wal
+                                                     else None),
+                                        cache_size=args.db_cache_size,
+                                        async_commit=args.async_commit,
+                                        flush_interval=args.flush_interval,
+                                        max_lag=args.max_lag),
+                                   args.rating_backend)
+    matching = create_matching_generator(comparator, args.method,
+                                         args.matching_process)
+    cache = ThumbnailCache(args.thumbnail_cache_mb * 1024 * 1024,
+                           args.thumbnail_dir or '%s.thumbs' % args.output,
+                           args.thumbnail_format)
+    scheduler = PairScheduler(matching, comparator.match_result,
+                              args.lease_timeout)
     iterator = ImageResponseIterator(names, comparator, matching,
-                                     args.max_size)
-
-    start_server(args.host, args.port, iterator, comparator)
+                                     args.max_size, cache, args.prefetch,
+                                     protocol=args.protocol,
+                                     scheduler=scheduler)
+
+    try:
+        start_server(args.host, args.port, iterator, comparator,
+                     args.server_workers, args.batch_size)
+    finally:
+        iterator.close()
+        matching.close()
+        comparator.close()
 
 
 if __name__ == '__main__':
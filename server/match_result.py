@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 from enum import IntEnum, auto
 
+import numpy as np
+
 
 class MatchResult(IntEnum):
     NONE = auto()
     WIN = auto()
     LOSE = auto()
     DRAW = auto()
+
+
+# Every state fits in one byte (8x smaller than the default int64)
+MATCH_RESULT_DTYPE = np.uint8
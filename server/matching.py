@@ -1,13 +1,18 @@
 # -*- coding: utf-8 -*-
+from __future__ import annotations
 from abc import ABCMeta, abstractmethod
+import bisect
+import heapq
 import random
-from typing import NoReturn, Tuple, Any
+from concurrent.futures import ProcessPoolExecutor
+from typing import NoReturn, Tuple, List, Dict, Iterator, Any
 
 import numpy as np
 from nptyping import NDArray
 
 from match_result import MatchResult
 from comparator import MatchComparator, RatedMatchComparator
+from shared import SharedStateReader, Handle
 
 # Logging
 from logging import getLogger, NullHandler
@@ -15,22 +20,181 @@ logger = getLogger(__name__)
 logger.addHandler(NullHandler())
 
 
+def _add_grouped(target: NDArray[(Any, Any), int], idxs: NDArray[int],
+                 source: NDArray[(Any, Any), int], cols: NDArray[int],
+                 value: MatchResult, sign: int, axis: int) -> NoReturn:
+    """ target[idxs[k], :] += sign * (source[:, cols[k]] == value) (axis=0),
+        or the same for target[:, idxs[k]] (axis=1), in bounded chunks.
+    """
+    chunk = max(1, 2 ** 24 // max(1, source.shape[0]))
+    for begin in range(0, len(idxs), chunk):
+        idx = idxs[begin:begin + chunk]
+        order = np.argsort(idx, kind='stable')
+        uniq, starts = np.unique(idx[order], return_index=True)
+        mask = source[:, cols[begin:begin + chunk][order]] == value
+        sums = np.add.reduceat(mask.astype(np.int32), starts, axis=1)
+
+        if axis == 0:
+            target[uniq, :] += sign * sums.T
+        else:
+            target[:, uniq] += sign * sums
+
+
+class _OpenMatchIndex():
+    """ Number of open (NONE) matches of each item, bucketed by the count.
+    """
+    def __init__(self, match_result_view: NDArray[(Any, Any), int]):
+        self._match_result = match_result_view
+        self.rebuild()
+
+    @property
+    def n_open(self) -> int:
+        return self._n_open
+
+    @property
+    def counts(self) -> NDArray[int]:
+        return self._counts
+
+    @property
+    def values(self) -> List[int]:
+        return self._values
+
+    def bucket(self, count: int) -> List[int]:
+        return self._buckets.get(count, [])
+
+    def rebuild(self) -> NoReturn:
+        n_items = self._match_result.shape[0]
+        self._counts = np.count_nonzero(
+                self._match_result == MatchResult.NONE, axis=1)
+        self._n_open = int(np.sum(self._counts)) // 2
+        self._buckets = dict()
+        self._values = list()
+        self._pos = np.zeros(n_items, dtype=int)
+        for item, count in enumerate(self._counts.tolist()):
+            self._insert(item, count)
+
+    def _insert(self, item: int, count: int) -> NoReturn:
+        bucket = self._buckets.get(count)
+        if bucket is None:
+            bucket = self._buckets[count] = list()
+            bisect.insort(self._values, count)
+        self._pos[item] = len(bucket)
+        bucket.append(item)
+
+    def _remove(self, item: int, count: int) -> NoReturn:
+        bucket = self._buckets[count]
+        last = bucket.pop()
+        if last != item:
+            bucket[self._pos[item]] = last
+            self._pos[last] = self._pos[item]
+        if len(bucket) == 0:
+            del self._buckets[count]
+            del self._values[bisect.bisect_left(self._values, count)]
+
+    def update(self, items: NDArray[int], delta: int) -> NoReturn:
+        items, n_changes = np.unique(items, return_counts=True)
+        for item, n_change in zip(items.tolist(), n_changes.tolist()):
+            count = self._counts[item].item()
+            self._remove(item, count)
+            self._insert(item, count + delta * n_change)
+            self._counts[item] = count + delta * n_change
+        self._n_open += delta * int(np.sum(n_changes)) // 2
+
+    def iter_bucket_pairs(self) -> Iterator[List[Tuple[int, int]]]:
+        """ Yield the pairs of (non-zero) counts, grouped by the sum of
+            counts in descending order.
+        """
+        values = [v for v in reversed(self._values) if v > 0]
+        if len(values) == 0:
+            return
+
+        heap = [(-2 * values[0], 0, 0)]
+        visited = {(0, 0)}
+        group, group_sum = list(), None
+        while len(heap) > 0:
+            neg_sum, i, j = heapq.heappop(heap)
+            if group_sum is not None and neg_sum != group_sum:
+                yield group
+                group = list()
+            group_sum = neg_sum
+            group.append((values[i], values[j]))
+
+            for ni, nj in ((i, j + 1), (i + 1, j + 1)):
+                if nj < len(values) and (ni, nj) not in visited:
+                    visited.add((ni, nj))
+                    heapq.heappush(heap, (-values[ni] - values[nj], ni, nj))
+        yield group
+
+
 class MatchingGenerator(metaclass=ABCMeta):
     def __init__(self, match_result_view: np.ndarray) -> NoReturn:
         self._match_result = match_result_view
+        self._attached = False
+        self._open_index = None
+
+    def attach(self, comparator: MatchComparator = None) -> MatchingGenerator:
+        # Without a comparator, the owner has to call update() itself
+        if comparator is not None:
+            comparator.add_listener(self.update)
+        self._attached = True
+        return self
+
+    def update(self, winners: NDArray[int], losers: NDArray[int],
+               resolved: bool) -> NoReturn:
+        if self._open_index is not None:
+            self._open_index.update(np.concatenate((winners, losers)),
+                                    -1 if resolved else 1)
+
+    def _get_open_index(self) -> _OpenMatchIndex:
+        if self._open_index is None:
+            self._open_index = _OpenMatchIndex(self._match_result)
+        elif not self._attached:
+            self._open_index.rebuild()
+        return self._open_index
 
     def _get_no_result_matches(self) -> NDArray[(2, Any), int]:
         return np.asarray(np.where(self._match_result == MatchResult.NONE))
 
+    def close(self) -> NoReturn:
+        pass
+
+    def candidates(self, n: int) -> List[Tuple[int, int]]:
+        """ Up to `n` pairs likely to follow the last one, best first. It
+            only reads what the last `__next__` left, so it may run in
+            another thread.
+        """
+        return list()
+
     @abstractmethod
     def __next__(self) -> Tuple[int, int]:
         raise NotImplementedError
 
 
 class RandomMatchingGenerator(MatchingGenerator):
+    def __init__(self, match_result_view: NDArray[(Any, Any), int],
+                 sampled: bool = True):
+        super().__init__(match_result_view)
+        self._sampled = sampled
+
+    def _sample_match(self) -> Tuple[int, int]:
+        index = self._get_open_index()
+        if index.n_open == 0:
+            raise StopIteration
+
+        # P(i, j) = count_i / sum(count) * 1 / count_i (uniform)
+        counts = [c for c in index.values if c > 0]
+        weights = [c * len(index.bucket(c)) for c in counts]
+        count = random.choices(counts, weights=weights)[0]
+        i = random.choice(index.bucket(count))
+        partners = np.nonzero(self._match_result[i] == MatchResult.NONE)[0]
+        return tuple(np.asarray((i, random.choice(partners))))
+
     def __next__(self) -> Tuple[int, int]:
+        if self._sampled:
+            return self._sample_match()
+
         matches = self._get_no_result_matches()
-        if len(matches) == 0:
+        if matches.shape[1] == 0:
             raise StopIteration
 
         idx = random.randint(0, matches.shape[1] - 1)
@@ -38,66 +202,201 @@ class RandomMatchingGenerator(MatchingGenerator):
 
 
 class FrequencyMatchingGenerator(MatchingGenerator):
-    def __next__(self) -> Tuple[int, int]:
-        matches = self._get_no_result_matches()
+    _N_TRIALS = 32
+
+    def _sample_match(self, index: _OpenMatchIndex,
+                      bucket_pairs: List[Tuple[int, int]]
+                      ) -> Tuple[int, int]:
+        blocks = [(index.bucket(c1), index.bucket(c2))
+                  for c1, c2 in bucket_pairs]
+        weights = [len(b1) * (len(b1) - 1) // 2 if b1 is b2
+                   else len(b1) * len(b2) for b1, b2 in blocks]
+        if sum(weights) == 0:
+            return None
+
+        # Rejection sampling is uniform over the open matches of the blocks
+        for _ in range(self._N_TRIALS):
+            b1, b2 = random.choices(blocks, weights=weights)[0]
+            if b1 is b2:
+                i, j = random.sample(b1, 2)
+            else:
+                i, j = random.choice(b1), random.choice(b2)
+            if self._match_result[i, j] == MatchResult.NONE:
+                return (i, j)
+
+        matches = list()
+        for b1, b2 in blocks:
+            same = b1 is b2
+            b1, b2 = np.asarray(b1), np.asarray(b2)
+            i, j = np.nonzero(self._match_result[np.ix_(b1, b2)] ==
+                              MatchResult.NONE)
+            if same:
+                i, j = i[i < j], j[i < j]
+            matches.extend(zip(b1[i].tolist(), b2[j].tolist()))
         if len(matches) == 0:
+            return None
+        return random.choice(matches)
+
+    def __next__(self) -> Tuple[int, int]:
+        index = self._get_open_index()
+        if index.n_open == 0:
             raise StopIteration
 
-        cnt = np.count_nonzero(self._match_result == MatchResult.NONE, axis=1)
-        n_matches = cnt[matches[0]] + cnt[matches[1]]
-        less_freq_matches = matches[:, n_matches == np.max(n_matches)]
+        # Less compared items have more remaining matches
+        for bucket_pairs in index.iter_bucket_pairs():
+            match = self._sample_match(index, bucket_pairs)
+            if match is not None:
+                return tuple(np.random.permutation(match))
 
-        idx = random.randint(0, less_freq_matches.shape[1] - 1)
-        return tuple(less_freq_matches[:, idx])
+        raise StopIteration
 
 
 class RatingBasedMatchingGenerator(MatchingGenerator):
     def __init__(self, match_result_view: NDArray[(Any, Any), int],
-                 rating_view: NDArray[(Any,), int]):
-        self._match_result = match_result_view
+                 rating_view: NDArray[(Any,), int], cached: bool = True):
+        super().__init__(match_result_view)
         self._rating = rating_view
+        self._state = None
+        self._cached = cached
+        self._wba = None
+        self._last_gain = None
+        self._last_pair = None
 
     def _calc_victory_probability(self, rate_diff: NDArray[(Any, Any), float]
                                   ) -> NDArray[(Any, Any), float]:
         return 1.0 / (10 ** (-rate_diff * 0.0025) + 1)
 
-    def _predict_n_transitive_gain(self) -> Tuple[NDArray[int], NDArray[int]]:
-        # Out _ {i, j} := np.count_nonzero(
+    def _build_victory_matrix(self) -> NDArray[(Any, Any), float]:
+        rate_diff = self._rating[:, np.newaxis] - self._rating[np.newaxis, :]
+        return self._calc_victory_probability(rate_diff).astype(np.float32)
+
+    def _get_victory_matrix(self) -> NDArray[(Any, Any), float]:
+        # Full recomputation is kept to verify the cache
+        if not self._cached:
+            return self._build_victory_matrix()
+
+        if self._wba is None:
+            self._wba = self._build_victory_matrix()
+            self._wba_rating = np.array(self._rating)
+            return self._wba
+
+        # Only the rows and columns of re-rated items are patched
+        changed = np.nonzero(self._rating != self._wba_rating)[0]
+        if len(changed) > 0:
+            rate = self._wba_rating
+            rate[changed] = self._rating[changed]
+            self._wba[changed, :] = self._calc_victory_probability(
+                    rate[changed, np.newaxis] - rate[np.newaxis, :])
+            self._wba[:, changed] = self._calc_victory_probability(
+                    rate[:, np.newaxis] - rate[np.newaxis, changed])
+        return self._wba
+
+    def _build_gain(self) -> NoReturn:
+        # Gain _ {i, j} := np.count_nonzero(
         #       result[i] == NONE & result[j] == RESULT)
         # RESULT = (WIN, LOSE)
+        self._state = np.array(self._match_result)
+        none_mask = (self._state == MatchResult.NONE).astype(np.float32)
+        win_mask = (self._state == MatchResult.WIN).astype(np.float32)
+        self._n_win = np.dot(none_mask, win_mask.T).astype(np.int32)
+        del win_mask
+        lose_mask = (self._state == MatchResult.LOSE).astype(np.float32)
+        self._n_lose = np.dot(none_mask, lose_mask.T).astype(np.int32)
+        self._n_open = np.count_nonzero(none_mask, axis=1)
+
+    def _apply(self, winners: NDArray[int], losers: NDArray[int],
+               resolved: bool) -> NoReturn:
+        if len(winners) == 0:
+            return
+
+        # (N + dN) (W + dW)^T = N W^T + dN W^T + (N + dN) dW^T
+        sign = 1 if resolved else -1
+        rows = np.concatenate((winners, losers))
+        cols = np.concatenate((losers, winners))
+        _add_grouped(self._n_win, rows, self._state, cols,
+                     MatchResult.WIN, -sign, axis=0)
+        _add_grouped(self._n_lose, rows, self._state, cols,
+                     MatchResult.LOSE, -sign, axis=0)
+
+        if resolved:
+            self._state[winners, losers] = MatchResult.WIN
+            self._state[losers, winners] = MatchResult.LOSE
+        else:
+            self._state[rows, cols] = MatchResult.NONE
+        np.add.at(self._n_open, rows, -sign)
+
+        _add_grouped(self._n_win, winners, self._state, losers,
+                     MatchResult.NONE, sign, axis=1)
+        _add_grouped(self._n_lose, losers, self._state, winners,
+                     MatchResult.NONE, sign, axis=1)
+
+    def _synchronize(self) -> NoReturn:
+        if self._state is None:
+            self._build_gain()
+            return
+        if self._attached:
+            return
+
+        # Without comparator notifications, diff against the last state
+        i, j = np.nonzero(self._match_result != self._state)
+        upper = i < j
+        i, j = i[upper], j[upper]
+
+        for values, resolved in ((self._state[i, j], False),
+                                 (self._match_result[i, j], True)):
+            decided = values != MatchResult.NONE
+            won = values[decided] == MatchResult.WIN
+            ii, jj = i[decided], j[decided]
+            self._apply(np.where(won, ii, jj), np.where(won, jj, ii),
+                        resolved)
+
+    def update(self, winners: NDArray[int], losers: NDArray[int],
+               resolved: bool) -> NoReturn:
+        if self._state is not None:
+            self._apply(np.asarray(winners), np.asarray(losers), resolved)
 
-        n_items = len(self._rating)
-        none_mask = self._match_result == MatchResult.NONE
-        none_mask = none_mask.astype(np.uint32).reshape(n_items, 1, n_items)
-        win_mask = self._match_result == MatchResult.WIN
-        win_mask = win_mask.astype(np.uint32).reshape(n_items, n_items, 1)
-        lose_mask = self._match_result == MatchResult.LOSE
-        lose_mask = lose_mask.astype(np.uint32).reshape(n_items, n_items, 1)
-
-        n_transitive_win = np.squeeze(np.dot(none_mask, win_mask))
-        n_transitive_lose = np.squeeze(np.dot(none_mask, lose_mask))
-
-        return (n_transitive_win.astype(np.int32),
-                n_transitive_lose.astype(np.int32))
+    def _predict_n_transitive_gain(self) -> Tuple[NDArray[int], NDArray[int]]:
+        self._synchronize()
+        return self._n_win, self._n_lose
 
     def __next__(self) -> Tuple[int, int]:
-        if len(self._get_no_result_matches()) == 0:
+        n_win, n_lose = self._predict_n_transitive_gain()
+        if not np.any(self._n_open):
             raise StopIteration
 
-        rate_mat = np.tile(self._rating, (len(self._rating),))
-        rate_mat = rate_mat.reshape(len(self._rating), -1)
-        rate_diff = rate_mat.T - rate_mat
-        wba = self._calc_victory_probability(rate_diff)
-
-        n_win, n_lose = self._predict_n_transitive_gain()
-        n_gain = n_lose + (n_win - n_lose) * wba
-        n_gain[self._match_result != MatchResult.NONE] = -1
+        n_gain = np.subtract(n_win, n_lose, dtype=np.float32)
+        n_gain *= self._get_victory_matrix()
+        n_gain += n_lose
+        n_gain[self._state != MatchResult.NONE] = -1
+        self._last_gain = n_gain
 
         max_gain = np.max(n_gain)
         most_valuable_match = np.asarray(np.where(n_gain == max_gain))
         idx = random.randint(0, most_valuable_match.shape[1] - 1)
 
-        return tuple(most_valuable_match[:, idx])
+        self._last_pair = tuple(most_valuable_match[:, idx])
+        return self._last_pair
+
+    def candidates(self, n: int) -> List[Tuple[int, int]]:
+        gain, last_pair = self._last_gain, self._last_pair
+        if gain is None or n <= 0:
+            return list()
+
+        # Both orientations of n pairs and the last pair fill 2n + 2 slots
+        flat = gain.ravel()
+        k = min(2 * n + 2, flat.size)
+        top = np.argpartition(flat, -k)[-k:]
+        top = top[np.argsort(flat[top])[::-1]]
+        top = top[flat[top] >= 0]
+        i, j = np.unravel_index(top, gain.shape)
+
+        seen = {frozenset(last_pair)} if last_pair is not None else set()
+        pairs = list()
+        for pair in zip(i.tolist(), j.tolist()):
+            if frozenset(pair) not in seen and len(pairs) < n:
+                seen.add(frozenset(pair))
+                pairs.append(pair)
+        return pairs
 
 
 class PseudoRatingBasedMatchingGenerator(RatingBasedMatchingGenerator):
@@ -107,43 +406,159 @@ class PseudoRatingBasedMatchingGenerator(RatingBasedMatchingGenerator):
 
 
 class IntroRatingBasedMatchingGenerator(PseudoRatingBasedMatchingGenerator):
+    def __init__(self, match_result_view: NDArray[(Any, Any), int],
+                 rating_view: NDArray[(Any,), int], cached: bool = True):
+        super().__init__(match_result_view, rating_view, cached)
+        self._last_neighbors = None
+
     def __next__(self) -> Tuple[int, int]:
-        matches = self._get_no_result_matches()
-        if len(matches) == 0:
+        self._synchronize()
+        if not np.any(self._n_open):
             raise StopIteration
 
-        n_items = self._rating.shape[0]
-        i, j = np.arange(0, n_items), np.arange(-1, n_items - 1)
-        idxs = np.where(self._match_result[i, j] == MatchResult.NONE)[0]
+        # Each item and the previous one, the first with the last
+        i = np.arange(0, self._rating.shape[0])
+        j = np.roll(i, 1)
+        idxs = np.where(self._state[i, j] == MatchResult.NONE)[0]
 
         # Use neighbor items
         if len(idxs) > 0:
+            self._last_neighbors = (i[idxs], j[idxs])
+            self._last_gain = None
             idx = random.choice(idxs)
-            return (i[idx], j[idx])
+            self._last_pair = (i[idx], j[idx])
+            return self._last_pair
 
         # Use rating based method
+        self._last_neighbors = None
         return super().__next__()
 
+    def candidates(self, n: int) -> List[Tuple[int, int]]:
+        neighbors = self._last_neighbors
+        if neighbors is None:
+            return super().candidates(n)
+
+        # Any open neighbor pair is equally likely
+        i, j = neighbors
+        last_pair = self._last_pair
+        idxs = [idx for idx in range(len(i))
+                if last_pair is None or
+                {i[idx], j[idx]} != set(last_pair)]
+        idxs = random.sample(idxs, min(n, len(idxs)))
+        return [(i[idx].item(), j[idx].item()) for idx in idxs]
+
+
+_worker = dict()
+
+
+def _init_matching_worker(handles: Dict[str, Handle], method: str
+                          ) -> NoReturn:
+    reader = SharedStateReader(handles)
+    generator = _create_matching_generator(reader.get('result'),
+                                           reader.get('rate'), method)
+    _worker['reader'] = reader
+    _worker['generator'] = generator.attach()
+
+
+def _next_in_matching_worker(updates: List[Tuple[NDArray[int], NDArray[int],
+                                                 bool]],
+                             n_candidates: int
+                             ) -> Tuple[Tuple[int, int], List[Tuple[int, int]],
+                                        int, int]:
+    reader, generator = _worker['reader'], _worker['generator']
+    for update in updates:
+        generator.update(*update)
+
+    version = reader.version
+    try:
+        match = next(generator)
+        candidates = generator.candidates(n_candidates)
+    except StopIteration:
+        match, candidates = None, list()
+    return match, candidates, version, reader.version
+
+
+class ProcessMatchingGenerator(MatchingGenerator):
+    """ Run a matching generator in a worker process over the shared,
+        memory-mapped state of the comparator.
+    """
+    _MAX_RETRY = 3
+    # Candidates come back with every pair, as asking costs a round trip
+    _N_CANDIDATES = 32
+
+    def __init__(self, comparator: MatchComparator, method: str):
+        if comparator.shared_handles is None:
+            raise ValueError('Comparator state is not shared.')
+
+        super().__init__(comparator.match_result)
+        self._comparator = comparator
+        self._updates = list()
+        self._candidates = list()
+        # Single worker, so that its incremental state sees every update
+        self._executor = ProcessPoolExecutor(
+                max_workers=1, initializer=_init_matching_worker,
+                initargs=(comparator.shared_handles, method))
+
+    def update(self, winners: NDArray[int], losers: NDArray[int],
+               resolved: bool) -> NoReturn:
+        self._updates.append((winners, losers, resolved))
+
+    def close(self) -> NoReturn:
+        self._executor.shutdown()
+
+    def candidates(self, n: int) -> List[Tuple[int, int]]:
+        return self._candidates[:n]
+
+    def __next__(self) -> Tuple[int, int]:
+        for _ in range(self._MAX_RETRY):
+            updates, self._updates = self._updates, list()
+            future = self._executor.submit(_next_in_matching_worker, updates,
+                                           self._N_CANDIDATES)
+            match, candidates, start, end = future.result()
+
+            # Computed on a state which was being updated
+            if start == end == self._comparator.version and start % 2 == 0:
+                break
+            logger.debug('Stale matching result (version %d, %d)', start, end)
+
+        self._candidates = candidates
+        if match is None:
+            raise StopIteration
+        return match
+
 
 def create_matching_generator(comparator: MatchComparator,
-                              method: str = 'intro') -> MatchingGenerator:
-    if isinstance(comparator, RatedMatchComparator):
+                              method: str = 'intro', process: bool = False
+                              ) -> MatchingGenerator:
+    if process:
+        logger.info('Run matching in a worker process.')
+        generator = ProcessMatchingGenerator(comparator, method)
+    else:
+        rating = comparator.rating \
+            if isinstance(comparator, RatedMatchComparator) else None
+        generator = _create_matching_generator(comparator.match_result,
+                                               rating, method)
+    return generator.attach(comparator)
+
+
+def _create_matching_generator(match_result: NDArray[(Any, Any), int],
+                               rating: NDArray[(Any,), float],
+                               method: str) -> MatchingGenerator:
+    if rating is not None:
         if method == 'intro':
             logger.info('Use intro rated matching method.')
-            return IntroRatingBasedMatchingGenerator(comparator.match_result,
-                                                     comparator.rating)
+            return IntroRatingBasedMatchingGenerator(match_result, rating)
         elif method == 'rating':
             logger.info('Use rated matching method.')
-            return PseudoRatingBasedMatchingGenerator(comparator.match_result,
-                                                      comparator.rating)
+            return PseudoRatingBasedMatchingGenerator(match_result, rating)
 
     if method == 'freq':
         logger.info('Use frequency matching method.')
-        return FrequencyMatchingGenerator(comparator.match_result)
+        return FrequencyMatchingGenerator(match_result)
     elif method == 'random':
-        logger.info('Use frequency matching method.')
-        return RandomMatchingGenerator(comparator.match_result)
+        logger.info('Use random matching method.')
+        return RandomMatchingGenerator(match_result)
 
     logger.warn('No avaliable method named "%s" is found.', method)
     logger.info('Use default matching method.')
-    return FrequencyMatchingGenerator(comparator.match_result)
+    return FrequencyMatchingGenerator(match_result)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+from typing import NoReturn, Any
+
+import numpy as np
+from nptyping import NDArray
+
+import db
+from comparator import MatchComparator, RatedMatchComparator, replay_rating
+from match_result import MatchResult
+
+
+class RankingEngine():
+    """ Total order of items, best first.
+
+        In a transitively closed result an item beats everything its loser
+        beats, so ordering by win counts respects every result. Items with
+        the same count are not comparable yet and follow their rating.
+    """
+    def __init__(self, wins: NDArray[int], rating: NDArray[float] = None):
+        self._wins = np.asarray(wins, dtype=np.int64)
+        self._rating = rating
+        self._order = None
+
+    @classmethod
+    def from_match_result(cls, match_result: NDArray[(Any, Any), int],
+                          rating: NDArray[float] = None) -> RankingEngine:
+        wins = np.count_nonzero(match_result == MatchResult.WIN, axis=1)
+        return cls(wins, rating)
+
+    @classmethod
+    def from_comparator(cls, comparator: MatchComparator) -> RankingEngine:
+        rating = getattr(comparator, 'rating', None)
+        return cls.from_match_result(comparator.match_result, rating)
+
+    @classmethod
+    def from_log(cls, n_items: int, logger: db.RatedMatchResultDBController,
+                 comparator_cls: type = RatedMatchComparator,
+                 chunk_size: int = 65536) -> RankingEngine:
+        """ Read the log without building the n x n matrix. Every decided
+            pair is a row of the log.
+
+            Older logs of the intro method hold the last item as -1, which
+            is wrapped like the matrix index it was used as.
+        """
+        wins = np.zeros(n_items, dtype=np.int64)
+        rating = np.full(n_items, 1500, dtype=np.float32)
+        for columns in logger.iter_columns(chunk_size=chunk_size):
+            columns['winner'] = columns['winner'] % n_items
+            columns['loser'] = columns['loser'] % n_items
+            wins += np.bincount(columns['winner'], minlength=n_items)
+            if 'winner_rate' in columns:
+                replay_rating(rating, columns,
+                              comparator_cls._calc_victory_probability)
+        return cls(wins, rating)
+
+    @property
+    def wins(self) -> NDArray[int]:
+        wins = self._wins.view()
+        wins.flags.writeable = False
+        return wins
+
+    @property
+    def rating(self) -> NDArray[float]:
+        return self._rating
+
+    def attach(self, comparator: MatchComparator) -> RankingEngine:
+        comparator.add_listener(self.update)
+        return self
+
+    def update(self, winners: NDArray[int], _: NDArray[int],
+               resolved: bool) -> NoReturn:
+        np.add.at(self._wins, winners, 1 if resolved else -1)
+        self._order = None
+
+    @property
+    def order(self) -> NDArray[int]:
+        # Ratings change with every result, so the order is sorted lazily
+        if self._order is None:
+            keys = [np.arange(len(self._wins))]
+            if self._rating is not None:
+                keys.append(-np.asarray(self._rating))
+            keys.append(-self._wins)
+            self._order = np.lexsort(keys)
+        return self._order
+
+    @property
+    def ranks(self) -> NDArray[int]:
+        ranks = np.empty_like(self.order)
+        ranks[self.order] = np.arange(len(self.order))
+        return ranks
@@ -1,69 +1,153 @@
 # -*- coding: utf-8 -*-
 import base64
-from typing import List, Tuple, Dict, Any
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NoReturn, List, Tuple, Dict, Hashable
 
 import numpy as np
-import cv2
-from nptyping import NDArray
 
 from comparator import MatchComparator
+from match_result import MatchResult
 from matching import MatchingGenerator
+from scheduler import PairScheduler
+from thumbnail import ThumbnailCache
 
+# Logging
+from logging import getLogger, NullHandler
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())
 
-def _load_image(filename: str) -> NDArray[(Any, Any, 3), int]:
-    return cv2.imread(filename, cv2.IMREAD_COLOR)
 
-
-def _resize_image(img: NDArray[(Any, Any, 3), int],
-                  max_size: int) -> NDArray[(Any, Any, 3), int]:
-    h, w = img.shape[:2]
-    ratio = max_size / max(h, w)
-
-    if ratio > 1:
-        return img
-
-    dst_h, dst_w = int(h * ratio), int(w * ratio)
-    return cv2.resize(img, (dst_w, dst_h))
-
-
-def _encode_b64_image(img: NDArray[(Any, Any, 3), int]) -> str:
-    ret, img = cv2.imencode('.jpg', img)
-
-    if not ret:
+def _encode_b64_image(data: bytes, mime_type: str = 'image/jpeg') -> str:
+    if data is None:
         return None
-
-    img = img.tostring()
-    img = base64.encodebytes(img)
-    return 'data:image/jpeg;base64,%s' % img.decode()
+    return 'data:%s;base64,%s' % (mime_type, base64.b64encode(data).decode())
 
 
-def _get_thumbnail(filename: str, max_size: int) -> str:
-    img = _load_image(filename)
-    img = _resize_image(img, max_size)
-    return _encode_b64_image(img)
+def _get_thumbnail_url(idx: int, max_size: int) -> str:
+    return '/thumb/%d/%d' % (idx, max_size)
 
 
 class ImageResponseIterator():
+    """ With `inline`, thumbnails are sent as base64 data URIs. With `url`,
+        responses only carry `/thumb/<id>/<size>` URLs, which the browser
+        fetches and caches, and the thumbnails prefetched for the next
+        pairs are listed in `upcoming`.
+    """
+    PROTOCOLS = ('inline', 'url')
+
     def __init__(self, filenames: List[str],
                  comparator: MatchComparator,
                  matching: MatchingGenerator,
-                 max_size: int = 400):
+                 max_size: int = 400, cache: ThumbnailCache = None,
+                 n_prefetch: int = 0, n_prefetch_workers: int = 2,
+                 protocol: str = 'inline', scheduler: PairScheduler = None):
+        if protocol not in self.PROTOCOLS:
+            raise ValueError('Unknown protocol: %s' % protocol)
+
         self._names = filenames
         self._comparator = comparator
         self._rating = self._comparator.rating
         self._matching = matching
+        self._scheduler = scheduler
         self._max_size = max_size
-
-    def _get_next_id(self) -> Tuple[int, int]:
-        idx = next(self._matching)
+        self._cache = cache or ThumbnailCache()
+        self._protocol = protocol
+
+        # Thumbnails of the likely next pairs are made while the user looks
+        # at the current one
+        self._n_prefetch = n_prefetch
+        self._prefetching = dict()
+        self._upcoming = list()
+        self._lock = threading.Lock()
+        self._executor = None
+        if n_prefetch > 0:
+            self._executor = ThreadPoolExecutor(
+                    max_workers=n_prefetch_workers,
+                    thread_name_prefix='prefetch')
+
+    def close(self) -> NoReturn:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    @property
+    def mime_type(self) -> str:
+        return self._cache.mime_type
+
+    def _is_valid(self, idx: int) -> bool:
+        return 0 <= idx < len(self._names)
+
+    def get_thumbnail_digest(self, idx: int) -> str:
+        """ Digest of a thumbnail without making it, or None if `idx` is out
+            of range.
+        """
+        if not self._is_valid(idx):
+            return None
+        return self._cache.get_digest(self._names[idx], self._max_size)
+
+    def get_thumbnail(self, idx: int) -> bytes:
+        """ Thumbnail bytes, or None if `idx` is out of range. """
+        if not self._is_valid(idx):
+            return None
+        return self._get_thumbnail(idx)
+
+    def _get_thumbnail(self, idx: int) -> bytes:
+        with self._lock:
+            future = self._prefetching.pop(idx, None)
+        # Wait only for work already started
+        if future is not None and not future.cancel():
+            return future.result()
+        return self._cache.get(self._names[idx], self._max_size)
+
+    def _prefetch(self) -> NoReturn:
+        items = set()
+        for pair in self._matching.candidates(self._n_prefetch):
+            items.update(pair)
+
+        with self._lock:
+            self._upcoming = sorted(items)
+            self._prefetching = {idx: future
+                                 for idx, future in self._prefetching.items()
+                                 if not future.done()}
+            for idx in items - set(self._prefetching):
+                self._prefetching[idx] = self._executor.submit(
+                        self._cache.get, self._names[idx], self._max_size)
+
+    def _start_prefetch(self) -> NoReturn:
+        if self._executor is None:
+            return
+        future = self._executor.submit(self._prefetch)
+        future.add_done_callback(self._log_prefetch_error)
+
+    @staticmethod
+    def _log_prefetch_error(future: Future) -> NoReturn:
+        if future.exception() is not None:
+            logger.warning('Failed to prefetch: %s', future.exception())
+
+    def release(self, client: Hashable, pair: Tuple[int, int] = None
+                ) -> NoReturn:
+        if self._scheduler is not None:
+            self._scheduler.release(client, pair)
+
+    def _get_next_id(self, client: Hashable = None) -> Tuple[int, int]:
+        if self._scheduler is not None:
+            idx = np.asarray(self._scheduler.lease(client))
+        else:
+            idx = next(self._matching)
         i1, i2 = np.argsort((self._rating[idx[0]], self._rating[idx[1]]))
 
         # Higher rating is first
         return (idx[i1].item(), idx[i2].item())
 
     def _get_image_response(self, idx: int) -> Dict:
-        name = self._names[idx]
-        thumb = _get_thumbnail(name, self._max_size)
+        # Inline thumbnails are filled in by `render`
+        thumb = None
+        if self._protocol == 'url':
+            thumb = _get_thumbnail_url(idx, self._max_size)
         return {
             'id': idx,
             'rate': self._rating[idx].item(),
@@ -71,15 +155,101 @@ class ImageResponseIterator():
         }
 
     def __next__(self) -> Dict:
-        idx1, idx2 = self._get_next_id()
+        return self.get_response()
 
+    def _get_progress(self) -> Dict:
         return {
-            'matches': {
-                'total': self._comparator.n_match,
-                'finished': self._comparator.n_finished,
-            },
+            'total': self._comparator.n_match,
+            'finished': self._comparator.n_finished,
+        }
+
+    def render(self, response: Dict) -> Dict:
+        """ Fill in the inline thumbnails of an unrendered response. This
+            needs no lock on the comparator.
+        """
+        if self._protocol != 'inline':
+            return response
+        targets = list(response.get('target', ()))
+        for pair in response.get('pairs', ()):
+            targets.extend(pair['target'])
+        for target in targets:
+            target['src'] = _encode_b64_image(
+                    self._get_thumbnail(target['id']), self._cache.mime_type)
+        return response
+
+    def get_response(self, client: Hashable = None, render: bool = True
+                     ) -> Dict:
+        """ Next pair for `client`, leased to it if there is a scheduler.
+            Without `render`, thumbnails are left to `render`.
+        """
+        self.release(client)
+        idx1, idx2 = self._get_next_id(client)
+
+        response = {
+            'matches': self._get_progress(),
             'target': [
                 self._get_image_response(idx1),
                 self._get_image_response(idx2),
             ],
         }
+        self._add_upcoming(response, (idx1, idx2))
+        self._start_prefetch()
+        return self.render(response) if render else response
+
+    def get_batch(self, client: Hashable, queued: List[Tuple[int, int]],
+                  batch_size: int, render: bool = True
+                  ) -> Tuple[Dict, List[Tuple[int, int]]]:
+        """ Pairs topping the queue of `client` up to `batch_size`, and the
+            new queue. Queued pairs which other answers have decided are
+            listed in `drop`.
+        """
+        result = self._comparator.match_result
+        dropped = [pair for pair in queued
+                   if result[pair] != MatchResult.NONE]
+        queued = [pair for pair in queued
+                  if result[pair] == MatchResult.NONE]
+        for pair in dropped:
+            self.release(client, pair)
+
+        pairs = list()
+        while len(queued) + len(pairs) < batch_size:
+            try:
+                pair = self._get_next_id(client)
+            except StopIteration:
+                break
+            # Without a scheduler the generator repeats itself
+            if pair in queued or pair in pairs:
+                break
+            pairs.append(pair)
+
+        if len(queued) + len(pairs) == 0:
+            raise StopIteration
+
+        response = {
+            'matches': self._get_progress(),
+            'drop': [list(pair) for pair in dropped],
+            'pairs': [
+                {
+                    'target': [
+                        self._get_image_response(idx1),
+                        self._get_image_response(idx2),
+                    ],
+                }
+                for idx1, idx2 in pairs
+            ],
+        }
+        self._add_upcoming(response, sum(pairs, ()))
+        self._start_prefetch()
+        if render:
+            response = self.render(response)
+        return response, queued + pairs
+
+    def _add_upcoming(self, response: Dict, shown: Tuple[int, ...]
+                      ) -> NoReturn:
+        if self._protocol == 'url':
+            # Candidates of the previous round, which are in the cache now
+            with self._lock:
+                upcoming = [idx for idx in self._upcoming
+                            if idx not in shown]
+            response['upcoming'] = [_get_thumbnail_url(idx, self._max_size)
+                                    for idx in upcoming]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import time
+import itertools
+import threading
+from typing import NoReturn, Tuple, FrozenSet, Set, Iterator, Hashable, Any
+
+from nptyping import NDArray
+
+from match_result import MatchResult
+from matching import MatchingGenerator
+
+# Logging
+from logging import getLogger, NullHandler
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())
+
+
+class PairScheduler():
+    """ Lease pairs of a matching generator to concurrent clients.
+
+        A pair sharing an item with a leased one may be resolved by the
+        pending answer, so pairs of free items are preferred. A client may
+        hold several leases. They end with an answer, a disconnection or
+        after `timeout` seconds.
+    """
+    _N_CANDIDATES = 32
+    _N_TRIALS = 16
+
+    def __init__(self, matching: MatchingGenerator,
+                 match_result_view: NDArray[(Any, Any), int],
+                 timeout: float = 300.0):
+        self._matching = matching
+        self._match_result = match_result_view
+        self._timeout = timeout
+        # client -> {frozenset(pair): (pair, deadline)}
+        self._leases = dict()
+        self._lock = threading.Lock()
+
+    @property
+    def n_leases(self) -> int:
+        with self._lock:
+            return sum(len(leases) for leases in self._leases.values())
+
+    def _expire(self) -> NoReturn:
+        now = time.monotonic()
+        for client, leases in list(self._leases.items()):
+            for key, (pair, deadline) in list(leases.items()):
+                if deadline < now:
+                    logger.info('Lease of %s expired.', pair)
+                    del leases[key]
+            if len(leases) == 0:
+                del self._leases[client]
+
+    def _is_open(self, pair: Tuple[int, int]) -> bool:
+        return self._match_result[pair] == MatchResult.NONE
+
+    def _resample(self, first: Tuple[int, int]
+                  ) -> Iterator[Tuple[int, int]]:
+        # Drawn one at a time, as a draw may cost a full matching step.
+        # Deterministic generators repeat themselves, so a repeat ends it.
+        drawn = {frozenset(first)}
+        for _ in range(self._N_TRIALS):
+            try:
+                pair = next(self._matching)
+            except StopIteration:
+                return
+            if frozenset(pair) in drawn:
+                return
+            drawn.add(frozenset(pair))
+            yield pair
+
+    def _choose(self, first: Tuple[int, int],
+                leased: Set[FrozenSet[int]], busy: Set[int]
+                ) -> Tuple[int, int]:
+        if len(busy) == 0:
+            return first
+
+        candidates = [first] + self._matching.candidates(self._N_CANDIDATES)
+        if len(candidates) == 1:
+            # Generators without candidates are sampled again
+            candidates = itertools.chain(candidates, self._resample(first))
+
+        # Disjoint from every lease, else at least not leased itself
+        fallback = None
+        for pair in candidates:
+            pair = (int(pair[0]), int(pair[1]))
+            if frozenset(pair) in leased or not self._is_open(pair):
+                continue
+            if busy.isdisjoint(pair):
+                return pair
+            fallback = fallback or pair
+        return fallback or first
+
+    def lease(self, client: Hashable) -> Tuple[int, int]:
+        """ Add a lease to those `client` holds. """
+        with self._lock:
+            self._expire()
+
+            first = next(self._matching)
+            first = (int(first[0]), int(first[1]))
+            leased = {key for leases in self._leases.values()
+                      for key in leases}
+            busy = {idx for pair in leased for idx in pair}
+
+            pair = self._choose(first, leased, busy)
+            self._leases.setdefault(client, dict())[frozenset(pair)] = \
+                (pair, time.monotonic() + self._timeout)
+            return pair
+
+    def release(self, client: Hashable, pair: Tuple[int, int] = None
+                ) -> NoReturn:
+        """ End the lease of `pair`, or every lease of `client`. """
+        with self._lock:
+            if pair is None:
+                self._leases.pop(client, None)
+                return
+
+            leases = self._leases.get(client, dict())
+            leases.pop(frozenset((int(pair[0]), int(pair[1]))), None)
+            if len(leases) == 0:
+                self._leases.pop(client, None)
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import os
 import json
-from typing import NoReturn
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import NoReturn, Callable, Dict, Any
 from tornado import web, websocket, httpserver, ioloop
 
 from comparator import MatchComparator
@@ -19,52 +21,149 @@ class MainHandler(web.RequestHandler):
         self.render('index.html')
 
 
+class ThumbnailHandler(web.RequestHandler):
+    _CACHE_CONTROL = 'private, max-age=3600'
+
+    def initialize(self, iterator: ImageResponseIterator,
+                   executor: Executor) -> NoReturn:
+        self._iter = iterator
+        self._executor = executor
+
+    async def get(self, idx: str, max_size: str) -> NoReturn:
+        # Only the configured size is made, so sizes cannot fill the cache
+        idx, max_size = int(idx), int(max_size)
+        if max_size != self._iter.max_size:
+            raise web.HTTPError(404)
+
+        loop = ioloop.IOLoop.current()
+        digest = await loop.run_in_executor(
+                self._executor, self._iter.get_thumbnail_digest, idx)
+        if digest is None:
+            raise web.HTTPError(404)
+
+        # Revalidation is answered before the thumbnail is made
+        self.set_header('Cache-Control', self._CACHE_CONTROL)
+        self.set_header('Etag', '"%s"' % digest)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        data = await loop.run_in_executor(
+                self._executor, self._iter.get_thumbnail, idx)
+        self.set_header('Content-Type', self._iter.mime_type)
+        self.write(data)
+
+    def compute_etag(self) -> str:
+        # Set from the thumbnail digest instead of hashing the body
+        return None
+
+
 class WSHandler(websocket.WebSocketHandler):
+    """ Matching and thumbnails are computed in `executor`, so that the
+        IOLoop keeps serving other connections. Tornado reads the next
+        message of a connection only after `on_message` has finished, and
+        `lock` serializes the comparator across connections, while
+        thumbnails are made outside it. Each connection holds a lease on the
+        pairs it shows until it answers or disconnects, and undo reverts its
+        own last answer.
+
+        With `batch_size` > 1, the client keeps a queue of that many pairs
+        and answers without waiting; every reply tops the queue up and
+        drops the queued pairs that answers have decided.
+    """
     def initialize(self, iterator: ImageResponseIterator,
-                   comparator: MatchComparator) -> NoReturn:
+                   comparator: MatchComparator, executor: Executor,
+                   lock: threading.Lock, batch_size: int = 1) -> NoReturn:
         self._iter = iterator
         self._comparator = comparator
-
-    def open(self) -> NoReturn:
+        self._executor = executor
+        self._lock = lock
+        self._batch_size = batch_size
+        self._queued = list()
+        # Answers of this connection, so that undo leaves others' alone
+        self._answers = list()
+
+    async def open(self) -> NoReturn:
         logger.info('Connection established.')
-        self.send_data()
-
-    def send_data(self) -> NoReturn:
-        try:
-            res = next(self._iter)
-            self.write_message(json.dumps(res))
-        except StopIteration:
+        await self.send_data()
+
+    def _step(self, action: Callable[..., Any], *args: Any) -> Dict:
+        with self._lock:
+            if action is not None:
+                action(*args)
+            try:
+                res = self._next()
+            except StopIteration:
+                return None
+        return self._iter.render(res)
+
+    def _next(self) -> Dict:
+        if self._batch_size > 1:
+            res, self._queued = self._iter.get_batch(
+                    self, self._queued, self._batch_size, render=False)
+            return res
+        return self._iter.get_response(self, render=False)
+
+    def _answer(self, winner: int, loser: int) -> NoReturn:
+        answered = {winner, loser}
+        self._queued = [pair for pair in self._queued
+                        if set(pair) != answered]
+        self._iter.release(self, (winner, loser))
+        trigger_id = self._comparator.set_match_result(winner, loser)
+        if trigger_id is not None:
+            self._answers.append(trigger_id)
+
+    def _undo(self) -> NoReturn:
+        if len(self._answers) > 0:
+            self._comparator.strip_match_result(self._answers.pop())
+
+    def on_close(self) -> NoReturn:
+        logger.info('Connection closed.')
+        self._iter.release(self)
+
+    async def send_data(self, action: Callable[..., Any] = None,
+                        *args: Any) -> NoReturn:
+        res = await ioloop.IOLoop.current().run_in_executor(
+                self._executor, self._step, action, *args)
+        if res is None:
             logger.info('All images have compared.')
             logger.info('Quit server')
             exit()
+        self.write_message(json.dumps(res))
 
-    def undo_match(self) -> NoReturn:
-        self._comparator.strip_match_result()
-        self.send_data()
+    async def undo_match(self) -> NoReturn:
+        await self.send_data(self._undo)
 
-    def add_match_result(self, winner: int, loser: int) -> NoReturn:
-        self._comparator.set_match_result(winner, loser)
-        self.send_data()
+    async def add_match_result(self, winner: int, loser: int) -> NoReturn:
+        await self.send_data(self._answer, winner, loser)
 
-    def on_message(self, msg):
+    async def on_message(self, msg):
         req = json.loads(msg)
 
         if req['action'] == 'undo':
-            self.undo_match()
+            await self.undo_match()
         elif req['action'] == 'select':
             winner = int(req['winner'])
             loser = int(req['loser'])
-            self.add_match_result(winner, loser)
             logger.info('ID[%05d] > ID[%05d]', winner, loser)
+            await self.add_match_result(winner, loser)
         else:
             logger.error('Unknown request: %s', req['action'])
 
 
 def start_server(host: str, port: int, iterator: ImageResponseIterator,
-                 comparator: MatchComparator) -> NoReturn:
+                 comparator: MatchComparator, n_workers: int = 1,
+                 batch_size: int = 1) -> NoReturn:
+    executor = ThreadPoolExecutor(max_workers=n_workers,
+                                  thread_name_prefix='handler')
     app = web.Application([
         (r'/', MainHandler),
-        (r'/ws', WSHandler, dict(iterator=iterator, comparator=comparator)),
+        (r'/ws', WSHandler, dict(iterator=iterator, comparator=comparator,
+                                 executor=executor,
+                                 lock=threading.Lock(),
+                                 batch_size=batch_size)),
+        (r'/thumb/([0-9]+)/([0-9]+)', ThumbnailHandler,
+         dict(iterator=iterator, executor=executor)),
     ],
         template_path=os.path.join(os.getcwd(), 'client/dist'),
         static_path=os.path.join(os.getcwd(), 'client/dist'),
@@ -73,4 +172,7 @@ def start_server(host: str, port: int, iterator: ImageResponseIterator,
     logger.info('Start server on http://%s:%d/', host, port)
     server = httpserver.HTTPServer(app)
     server.listen(port, address=host)
-    ioloop.IOLoop.current().start()
+    try:
+        ioloop.IOLoop.current().start()
+    finally:
+        executor.shutdown(wait=False)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from typing import NoReturn, Tuple, Dict, Any
+
+import numpy as np
+from nptyping import NDArray
+
+# Handle := (path, shape, dtype)
+Handle = Tuple[str, Tuple[int, ...], str]
+
+
+def _default_dir() -> str:
+    # Prefer tmpfs so that the mapped files never touch the disk
+    return '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class SharedState():
+    """ Arrays in memory-mapped files, readable by other processes.
+
+        The single writer publishes a version counter, which is odd while
+        an update is in progress.
+    """
+    def __init__(self, dirname: str = None):
+        self._dirname = tempfile.mkdtemp(prefix='ranking-',
+                                         dir=dirname or _default_dir())
+        self._handles = dict()
+        self._version = self.allocate('version', (1,), np.int64, 0)
+
+    @property
+    def handles(self) -> Dict[str, Handle]:
+        return dict(self._handles)
+
+    def allocate(self, name: str, shape: Tuple[int, ...], dtype: Any,
+                 fill: Any) -> NDArray[Any]:
+        path = os.path.join(self._dirname, '%s.bin' % name)
+        array = np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+        array[...] = fill
+        self._handles[name] = (path, shape, np.dtype(dtype).str)
+        return array
+
+    def publish(self, version: int) -> NoReturn:
+        self._version[0] = version
+
+    def close(self) -> NoReturn:
+        shutil.rmtree(self._dirname, ignore_errors=True)
+
+
+class SharedStateReader():
+    def __init__(self, handles: Dict[str, Handle]):
+        self._arrays = {
+            name: np.memmap(path, dtype=np.dtype(dtype), mode='r',
+                            shape=tuple(shape))
+            for name, (path, shape, dtype) in handles.items()
+        }
+
+    @property
+    def version(self) -> int:
+        return self._arrays['version'][0].item()
+
+    def get(self, name: str) -> NDArray[Any]:
+        return self._arrays.get(name)
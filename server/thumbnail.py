@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import struct
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from typing import NoReturn, Tuple, List, Dict, Any
+
+import cv2
+from nptyping import NDArray
+
+# Logging
+from logging import getLogger, NullHandler
+logger = getLogger(__name__)
+logger.addHandler(NullHandler())
+
+# Key := (path, mtime_ns, max_size)
+Key = Tuple[str, int, int]
+
+MIME_TYPES = {
+    'jpg': 'image/jpeg',
+    'webp': 'image/webp',
+}
+
+
+# Start of frame markers, which hold the image size
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length field
+_STANDALONE_MARKERS = frozenset(range(0xD0, 0xDA)) | {0x01}
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def _probe_jpeg_size(filename: str) -> Tuple[int, int]:
+    """ (height, width) from the JPEG header, or None if it is not JPEG. """
+    try:
+        with open(filename, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return None
+
+            while True:
+                byte = f.read(1)
+                while byte and byte != b'\xff':
+                    byte = f.read(1)
+                while byte == b'\xff':
+                    byte = f.read(1)
+                if not byte:
+                    return None
+
+                marker = byte[0]
+                if marker in _STANDALONE_MARKERS:
+                    continue
+
+                header = f.read(2)
+                if len(header) < 2:
+                    return None
+                length, = struct.unpack('>H', header)
+                if marker in _SOF_MARKERS:
+                    frame = f.read(5)
+                    if len(frame) < 5:
+                        return None
+                    _, height, width = struct.unpack('>BHH', frame)
+                    return height, width
+                f.seek(length - 2, os.SEEK_CUR)
+    except OSError:
+        return None
+
+
+def _get_imread_flag(filename: str, max_size: int) -> int:
+    # JPEG decoders skip the detail of a 1/2, 1/4 or 1/8 scale for free,
+    # as long as the result stays larger than the thumbnail
+    size = _probe_jpeg_size(filename)
+    if size is not None:
+        for scale, flag in _REDUCED_FLAGS:
+            if max(size) // scale >= max_size:
+                return flag
+    return cv2.IMREAD_COLOR
+
+
+def _load_image(filename: str, max_size: int = None
+                ) -> NDArray[(Any, Any, 3), int]:
+    if max_size is None:
+        return cv2.imread(filename, cv2.IMREAD_COLOR)
+    return cv2.imread(filename, _get_imread_flag(filename, max_size))
+
+
+def _resize_image(img: NDArray[(Any, Any, 3), int],
+                  max_size: int) -> NDArray[(Any, Any, 3), int]:
+    h, w = img.shape[:2]
+    ratio = max_size / max(h, w)
+
+    if ratio > 1:
+        return img
+
+    dst_h, dst_w = int(h * ratio), int(w * ratio)
+    return cv2.resize(img, (dst_w, dst_h))
+
+
+def create_thumbnail(filename: str, max_size: int, fmt: str = 'jpg'
+                     ) -> bytes:
+    img = _load_image(filename, max_size)
+    if img is None:
+        return None
+    img = _resize_image(img, max_size)
+
+    ret, img = cv2.imencode('.%s' % fmt, img)
+    if not ret:
+        return None
+    return img.tobytes()
+
+
+def _hash_file(filename: str) -> str:
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ThumbnailCache():
+    """ Thumbnails keyed by (path, mtime, max_size).
+
+        Recently used thumbnails are kept in memory up to `max_bytes`. When
+        `dirname` is given, every thumbnail is also stored there under the
+        hash of the image content, which `precompute_thumbnails` fills
+        ahead of time.
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024,
+                 dirname: str = None, fmt: str = 'jpg'):
+        if fmt not in MIME_TYPES:
+            raise ValueError('Unknown thumbnail format: %s' % fmt)
+
+        self._max_bytes = max_bytes
+        self._dirname = dirname
+        self._fmt = fmt
+        self._memory = OrderedDict()
+        self._n_bytes = 0
+        self._content_digests = dict()
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+        if dirname is not None:
+            os.makedirs(dirname, exist_ok=True)
+
+    @property
+    def mime_type(self) -> str:
+        return MIME_TYPES[self._fmt]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, n_bytes=self._n_bytes,
+                        n_items=len(self._memory))
+
+    @staticmethod
+    def _get_key(filename: str, max_size: int) -> Key:
+        path = os.path.abspath(filename)
+        return (path, os.stat(path).st_mtime_ns, max_size)
+
+    @staticmethod
+    def _get_digest(key: Key) -> str:
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def get_digest(self, filename: str, max_size: int) -> str:
+        # Changes whenever the thumbnail does, so it can serve as an ETag
+        return self._get_digest(self._get_key(filename, max_size))
+
+    def _get_disk_path(self, key: Key) -> str:
+        # Hashing the content costs far less than decoding it, and only
+        # happens once per file and mtime
+        path, mtime, max_size = key
+        with self._lock:
+            digest = self._content_digests.get((path, mtime))
+        if digest is None:
+            digest = _hash_file(path)
+            with self._lock:
+                self._content_digests[(path, mtime)] = digest
+
+        return os.path.join(self._dirname, digest[:2],
+                            '%s-%d.%s' % (digest, max_size, self._fmt))
+
+    def get(self, filename: str, max_size: int) -> bytes:
+        key = self._get_key(filename, max_size)
+
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return data
+
+        data = self._load(key)
+        if data is not None:
+            self._count('disk_hits')
+        else:
+            self._count('misses')
+            data = create_thumbnail(filename, max_size, self._fmt)
+            if data is None:
+                logger.warning('Failed to create thumbnail of %s', filename)
+                return None
+            self._save(key, data)
+
+        self._remember(key, data)
+        return data
+
+    def store(self, filename: str, max_size: int) -> bool:
+        """ Write a thumbnail to the disk only. False if it was there. """
+        key = self._get_key(filename, max_size)
+        if os.path.exists(self._get_disk_path(key)):
+            return False
+
+        data = create_thumbnail(filename, max_size, self._fmt)
+        if data is None:
+            logger.warning('Failed to create thumbnail of %s', filename)
+            return False
+        self._save(key, data)
+        return True
+
+    def _count(self, name: str) -> NoReturn:
+        with self._lock:
+            self._stats[name] += 1
+
+    def _remember(self, key: Key, data: bytes) -> NoReturn:
+        if len(data) > self._max_bytes:
+            return
+
+        with self._lock:
+            if key in self._memory:
+                return
+            self._memory[key] = data
+            self._n_bytes += len(data)
+            while self._n_bytes > self._max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._n_bytes -= len(evicted)
+
+    def _load(self, key: Key) -> bytes:
+        if self._dirname is None:
+            return None
+        try:
+            with open(self._get_disk_path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _save(self, key: Key, data: bytes) -> NoReturn:
+        if self._dirname is None:
+            return
+        path = self._get_disk_path(key)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning('Failed to save thumbnail: %s', e)
+
+
+_precompute_cache = dict()
+
+
+def _init_precompute_worker(dirname: str, fmt: str) -> NoReturn:
+    _precompute_cache['cache'] = ThumbnailCache(0, dirname, fmt)
+
+
+def _precompute_in_worker(task: Tuple[str, List[int]]) -> int:
+    filename, sizes = task
+    cache = _precompute_cache['cache']
+    try:
+        return sum(cache.store(filename, size) for size in sizes)
+    except OSError as e:
+        logger.warning('Failed to read %s: %s', filename, e)
+        return 0
+
+
+def precompute_thumbnails(filenames: List[str], sizes: List[int],
+                          dirname: str, fmt: str = 'jpg',
+                          n_workers: int = None) -> Dict[str, Any]:
+    """ Fill the disk cache of `dirname` using every core. Existing entries
+        are skipped, so an interrupted run resumes where it stopped.
+    """
+    n_workers = n_workers or multiprocessing.cpu_count()
+    ThumbnailCache(0, dirname, fmt)
+
+    start = time.perf_counter()
+    n_created = 0
+    tasks = [(name, sizes) for name in filenames]
+    with multiprocessing.Pool(n_workers, _init_precompute_worker,
+                              (dirname, fmt)) as pool:
+        results = pool.imap_unordered(_precompute_in_worker, tasks,
+                                      chunksize=8)
+        for i, n in enumerate(results, 1):
+            n_created += n
+            if i % 1000 == 0:
+                logger.info('%d / %d images (%.1f images/s)', i,
+                            len(tasks), i / (time.perf_counter() - start))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'n_images': len(filenames),
+        'n_created': n_created,
+        'elapsed': elapsed,
+        'images_per_sec': len(filenames) / elapsed if elapsed > 0 else 0.0,
+    }
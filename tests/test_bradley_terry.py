@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+from unittest import TestCase
+import tempfile
+
+import numpy as np
+
+from server import bradley_terry
+from server import comparator
+from server import db
+from server import matching
+
+
+class TestFitBradleyTerry(TestCase):
+    def _simulate(self, n_items, n_matches, seed=0):
+        rng = np.random.RandomState(seed)
+        score = rng.normal(1500, 200, n_items)
+        i = rng.randint(0, n_items, n_matches)
+        j = (i + rng.randint(1, n_items, n_matches)) % n_items
+        p = 1.0 / (10 ** ((score[j] - score[i]) / 400) + 1)
+        won = rng.rand(n_matches) < p
+        return score, np.where(won, i, j), np.where(won, j, i)
+
+    def test_fit(self):
+        score, winners, losers = self._simulate(50, 5000)
+        games = bradley_terry.count_games(winners, losers, 50)
+        rating, _ = bradley_terry.fit_bradley_terry(*games)
+        self.assertGreater(np.corrcoef(score, rating)[0, 1], 0.95)
+
+    def test_unbeaten(self):
+        games = bradley_terry.count_games([0, 0, 1], [1, 2, 2], 4)
+        rating, _ = bradley_terry.fit_bradley_terry(*games)
+        self.assertTrue(np.all(np.isfinite(rating)))
+        self.assertGreater(rating[0], rating[1])
+        self.assertGreater(rating[1], rating[2])
+        # Not compared item stays in the middle
+        self.assertAlmostEqual(rating[3], 1500, places=3)
+
+    def test_warm_start(self):
+        _, winners, losers = self._simulate(200, 20000)
+        games = bradley_terry.count_games(winners[:-100], losers[:-100], 200)
+        init, n_cold = bradley_terry.fit_bradley_terry(*games)
+
+        games = bradley_terry.count_games(winners, losers, 200)
+        cold, _ = bradley_terry.fit_bradley_terry(*games)
+        warm, n_warm = bradley_terry.fit_bradley_terry(*games, init=init)
+        self.assertLess(n_warm, n_cold)
+        np.testing.assert_allclose(warm, cold, atol=0.5)
+
+
+class TestBradleyTerryComparator(TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        db_name = os.path.join(self.dirname, 'test.db')
+        self.logger = db.RatedMatchResultDBController(db_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _expected(self, comp):
+        fitter = bradley_terry.BradleyTerryFitter(6, background=False)
+        fitter.load(comp.match_result)
+        return fitter.refit()
+
+    def test_fitted_rating(self):
+        fitter = bradley_terry.BradleyTerryFitter(6, background=False)
+        comp = comparator.RatedMatchComparator(6, self.logger, fitter=fitter)
+        comp.set_match_result(0, 1)
+        comp.set_match_result(1, 2)
+
+        # Fits are applied at the next update
+        np.testing.assert_array_equal(comp.rating, 1500)
+        fitter.refit()
+        comp.set_match_result(3, 4)
+        np.testing.assert_allclose(comp.rating[:3], self._expected(comp)[:3],
+                                   atol=0.5)
+        self.assertGreater(comp.rating[0], comp.rating[1])
+
+        comp.strip_match_result()
+        comp.strip_match_result()
+        fitter.refit()
+        expected = self._expected(comp)
+        comp.set_match_result(5, 4)
+        np.testing.assert_allclose(comp.rating, expected, atol=0.5)
+        comp.close()
+
+        # Loaded from the log
+        fitter = bradley_terry.BradleyTerryFitter(6, background=False)
+        loaded = comparator.RatedMatchComparator(6, self.logger,
+                                                 fitter=fitter)
+        np.testing.assert_allclose(loaded.rating, self._expected(comp),
+                                   atol=0.5)
+        loaded.close()
+
+    def test_background(self):
+        comp = comparator.create_comparater(
+                6, os.path.join(self.dirname, 'bg.db'),
+                rating_backend='bt')
+        comp.set_match_result(0, 1)
+        comp._fitter.refit()
+        comp.set_match_result(2, 3)
+        self.assertGreater(comp.rating[0], comp.rating[1])
+        comp.close()
+
+    def test_intro_matching(self):
+        fitter = bradley_terry.BradleyTerryFitter(6, background=False)
+        comp = comparator.RatedMatchComparator(6, self.logger, fitter=fitter)
+        for i in range(1, 5):
+            comp.set_match_result(i + 1, i)
+        comp.set_match_result(0, 1)
+
+        # The only open neighbor pair is the first and the last item
+        generator = matching.IntroRatingBasedMatchingGenerator(
+                comp.match_result, comp.rating)
+        self.assertEqual(next(generator), (0, 5))
+        comp.set_match_result(0, 5)
+        rating = fitter.refit()
+        self.assertGreater(rating[0], rating[5])
+        comp.close()
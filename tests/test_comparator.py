@@ -8,6 +8,7 @@ import numpy as np
 
 from server import comparator
 from server import db
+from server.checkpoint import Checkpoint
 from server.match_result import MatchResult
 
 
@@ -49,6 +50,74 @@ class TestMatchComparator(TestCase):
         self.assertEqual(result[1, 2], MatchResult.NONE)
         self.assertEqual(result[0, 2], MatchResult.NONE)
 
+    def test_duplicate_answer(self):
+        comp = comparator.MatchComparator(5, self.logger)
+        result = comp.match_result
+
+        comp.set_match_result(1, 0)
+        comp.set_match_result(2, 1)
+        # Decided already, so there is nothing to undo for it
+        comp.set_match_result(2, 0)
+        comp.strip_match_result()
+        self.assertEqual(result[1, 2], MatchResult.NONE)
+        self.assertEqual(result[0, 1], MatchResult.LOSE)
+
+    def test_delete_earlier(self):
+        comp = comparator.MatchComparator(6, self.logger)
+        result = comp.match_result
+
+        first = comp.set_match_result(1, 0)
+        comp.set_match_result(3, 2)
+        self.assertTrue(comp.strip_match_result(first))
+        self.assertEqual(result[1, 0], MatchResult.NONE)
+        self.assertEqual(result[3, 2], MatchResult.WIN)
+
+        # 3 > 0 was inferred with the earlier answer
+        first = comp.set_match_result(2, 0)
+        comp.set_match_result(4, 3)
+        self.assertFalse(comp.strip_match_result(first))
+        self.assertEqual(result[3, 0], MatchResult.WIN)
+        self.assertFalse(comp.strip_match_result(first + 100))
+
+    def test_failed_write(self):
+        comp = comparator.MatchComparator(5, self.logger, shared=True)
+        comp.set_match_result(2, 1)
+        expected = comp.match_result.copy()
+
+        def add(**kwargs):
+            raise IOError('disk full')
+        self.logger.add = add
+
+        with self.assertRaises(IOError):
+            comp.set_match_result(1, 0)
+        # Shared readers do not wait for an update which never ends
+        self.assertEqual(comp.version % 2, 0)
+        # Nor is the answer decided without its rows
+        np.testing.assert_array_equal(comp.match_result, expected)
+        del self.logger.add
+        self.assertTrue(comp.strip_match_result())
+        self.assertFalse(comp.strip_match_result())
+        comp.close()
+
+    def test_merge_chains(self):
+        comp = comparator.MatchComparator(8, self.logger)
+        result = comp.match_result
+
+        # 3 > 2 > 1 > 0 and 7 > 6 > 5 > 4, then join them with 4 > 3
+        for winner, loser in ((1, 0), (2, 1), (3, 2), (5, 4), (6, 5), (7, 6)):
+            comp.set_match_result(winner, loser)
+        comp.set_match_result(4, 3)
+
+        self.assertEqual(np.count_nonzero(result == MatchResult.NONE), 0)
+        self.assertListEqual(
+            list(np.count_nonzero(result == MatchResult.WIN, axis=1)),
+            list(range(8))
+        )
+        self.assertEqual(len(self.logger.get()), 8 * 7 // 2)
+
+        comp.strip_match_result()
+        self.assertEqual(np.count_nonzero(result == MatchResult.NONE), 16 * 2)
+
     def test_load(self):
         with self.logger:
             self.logger.add((0, 1, 2), (1, 2, 2), (0, 1, 0), (0, 1, 1))
@@ -58,6 +127,14 @@ class TestMatchComparator(TestCase):
         self.assertEqual(result[0, 1], MatchResult.LOSE)
         self.assertEqual(result[0, 2], MatchResult.LOSE)
 
+    def test_compact_result(self):
+        comp = comparator.MatchComparator(100, self.logger)
+        result = comp.match_result
+
+        self.assertEqual(result.nbytes, 100 * 100)
+        self.assertFalse(result.flags.writeable)
+        self.assertTrue(np.all(np.diag(result) == MatchResult.DRAW))
+
 
 class TestRatedMatchComparator(TestCase):
     def setUp(self):
@@ -121,11 +198,25 @@ class TestRatedMatchComparator(TestCase):
         self.assertTrue(abs(rate[2] - 1500.0) < 0.02,
                         msg='expected: %.2f, actual: %.2f' % (1500.0, rate[0]))
 
+    def test_failed_write(self):
+        comp = comparator.RatedMatchComparator(5, self.logger)
+        comp.set_match_result(2, 1)
+        result, rate = comp.match_result.copy(), comp.rating.copy()
+
+        def add(**kwargs):
+            raise IOError('disk full')
+        self.logger.add = add
+
+        with self.assertRaises(IOError):
+            comp.set_match_result(1, 0)
+        np.testing.assert_array_equal(comp.match_result, result)
+        np.testing.assert_array_equal(comp.rating, rate)
+
     def test_load(self):
         with self.logger:
             self.logger.add((0, 1, 2), (1, 2, 2), (0, 1, 0), (0, 1, 1),
                             1500, 1500)
-        comp = comparator.RatedMatchComparator(5, self.logger)
+        comp = comparator.RatedMatchComparator(5, self.logger, simulate=True)
         result = comp.match_result
         rate = comp.rating
 
@@ -137,3 +228,37 @@ class TestRatedMatchComparator(TestCase):
                         msg='expected: %.2f, actual: %.2f' % (1499.3, rate[1]))
         self.assertTrue(abs(rate[2] - 1531.23) < 0.02,
                         msg='expected: %.2f, actual: %.2f' % (1531.2, rate[2]))
+
+    def test_load_rating(self):
+        comp = comparator.RatedMatchComparator(5, self.logger)
+        comp.set_match_result(1, 0)
+        comp.set_match_result(2, 1)
+        comp.set_match_result(4, 3)
+
+        loaded = comparator.RatedMatchComparator(5, self.logger)
+        np.testing.assert_array_equal(loaded.match_result, comp.match_result)
+        np.testing.assert_allclose(loaded.rating, comp.rating, atol=0.01)
+
+    def test_checkpoint(self):
+        db_name = os.path.join(self.dirname, 'test.db')
+        comp = comparator.RatedMatchComparator(
+                6, self.logger, checkpoint=Checkpoint(db_name, interval=2))
+        comp.set_match_result(1, 0)
+        comp.set_match_result(2, 1)
+        self.assertTrue(os.path.exists(db_name + '.ckpt.npz'))
+        comp.set_match_result(4, 3)
+
+        # Restored from the checkpoint plus the match after it
+        loaded = comparator.RatedMatchComparator(
+                7, self.logger, checkpoint=Checkpoint(db_name, interval=2))
+        np.testing.assert_array_equal(loaded.match_result[:6, :6],
+                                      comp.match_result)
+        np.testing.assert_allclose(loaded.rating[:6], comp.rating, atol=0.01)
+        self.assertEqual(loaded.match_result[6, 0], MatchResult.NONE)
+
+        # Undoing a checkpointed match drops the checkpoint
+        loaded.strip_match_result()
+        loaded.strip_match_result()
+        self.assertFalse(os.path.exists(db_name + '.ckpt.npz'))
+        self.assertEqual(loaded.match_result[2, 1], MatchResult.NONE)
+        self.assertEqual(loaded.match_result[0, 1], MatchResult.LOSE)
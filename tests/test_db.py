@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 import os
+import sqlite3
 from unittest import TestCase
 import tempfile
 
+import numpy as np
+from sqlalchemy import text
+
 from server import db
+from server.db.controller import _dress_columns
 
 
 def use_temp_db(filename):
@@ -95,6 +100,37 @@ class TestMatchResultDBController(TestCase):
             'trigger_id': 0,
         })
 
+    @use_temp_db('test.db')
+    def test_persistent(self, filename):
+        logger = db.MatchResultDBController(filename, persistent=True)
+        self.assertEqual(logger.current_id, 0)
+        with logger as lg:
+            lg.add((1, 2), (1, 2), (2, 3), 1)
+            # Nested blocks share the open transaction
+            self.assertEqual(lg.current_id, 2)
+
+        with logger as lg:
+            deleted = lg.delete(1)
+        self.assertEqual(len(deleted), 2)
+        self.assertEqual(logger.get(), [])
+        self.assertEqual(logger.current_id, 0)
+        logger.dispose()
+
+    @use_temp_db('test.db')
+    def test_migrate_index(self, filename):
+        # Schema written before `triggered_by` was indexed
+        with sqlite3.connect(filename) as conn:
+            conn.execute('CREATE TABLE match_result (id INTEGER PRIMARY KEY,'
+                         ' winner INTEGER NOT NULL, loser INTEGER NOT NULL,'
+                         ' triggered_by INTEGER)')
+        db.MatchResultDBController(filename)
+
+        with sqlite3.connect(filename) as conn:
+            plan = conn.execute('EXPLAIN QUERY PLAN SELECT id FROM '
+                                'match_result WHERE triggered_by = 1')
+            detail = ' '.join(row[-1] for row in plan)
+        self.assertIn('ix_match_result_triggered_by', detail)
+
 
 class TestRatedMatchResultDBController(TestCase):
     def test_get_from_blank(self):
@@ -168,6 +204,76 @@ class TestRatedMatchResultDBController(TestCase):
             'loser_rate': 1450.0,
         })
 
+    @use_temp_db('test.db')
+    def test_async_commit(self, filename):
+        logger = db.RatedMatchResultDBController(
+                filename, persistent=True, wal=True, synchronous='NORMAL',
+                async_commit=True, flush_interval=10.0, max_lag=2)
+        for i in range(5):
+            with logger as lg:
+                lg.add(i + 1, i, i + 1, i + 1, 1500.0, 1500.0)
+
+        # Reads and deletes wait for the queued commits
+        self.assertEqual(logger.current_id, 5)
+        with logger as lg:
+            deleted = lg.delete(5)
+        self.assertEqual(deleted[0]['id'], 5)
+        self.assertEqual([r['id'] for r in logger.get(ordered=True)],
+                         [1, 2, 3, 4])
+
+        with logger as lg:
+            mode = lg._session.execute(text('PRAGMA journal_mode')).scalar()
+        self.assertEqual(mode, 'wal')
+        logger.dispose()
+
+    @use_temp_db('test.db')
+    def test_iter_columns(self, filename):
+        logger = db.RatedMatchResultDBController(filename)
+        with logger as lg:
+            lg.add((1, 2, 3), (0, 1, 2), (1, 2, 3), (1, 2, 2),
+                   (1500, 1510, 1520), (1490, 1480, 1470))
+
+        chunks = list(logger.iter_columns(start_id=1, chunk_size=1))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual([c['id'].tolist() for c in chunks], [[2], [3]])
+        self.assertEqual(chunks[1]['trigger_id'].tolist(), [2])
+        self.assertEqual(chunks[1]['loser_rate'].tolist(), [1470.0])
+        self.assertEqual(list(logger.iter_columns(start_id=3)), [])
+
+    def test_dress_columns(self):
+        rows = _dress_columns(match_id=np.arange(3), winner_rate=1500.0,
+                              loser_rate=(1490.0, 1480.0))
+        self.assertEqual(rows, [
+            {'match_id': 0, 'winner_rate': 1500.0, 'loser_rate': 1490.0},
+            {'match_id': 1, 'winner_rate': 1500.0, 'loser_rate': 1480.0},
+            {'match_id': 2, 'winner_rate': 1500.0, 'loser_rate': None},
+        ])
+        self.assertEqual(_dress_columns(id=1, label='a'),
+                         [{'id': 1, 'label': 'a'}])
+
+    @use_temp_db('test.db')
+    def test_add_bulk(self, filename):
+        n_rows = 10000
+        ids = np.arange(1, n_rows + 1)
+        logger = db.RatedMatchResultDBController(filename)
+        with logger as lg:
+            # One trigger id for every row, and for the first row only
+            lg.add(ids, ids % 100, ids % 100 + 100, (1,), 1510.0,
+                   np.full(n_rows, 1490.0))
+
+        chunks = list(logger.iter_columns(chunk_size=4096))
+        self.assertEqual([len(c['id']) for c in chunks], [4096, 4096, 1808])
+        columns = {key: np.concatenate([c[key] for c in chunks])
+                   for key in chunks[0]}
+        np.testing.assert_array_equal(columns['id'], ids)
+        np.testing.assert_array_equal(columns['winner'], ids % 100)
+        np.testing.assert_array_equal(columns['loser'], ids % 100 + 100)
+        # Missing triggers are read as -1
+        self.assertEqual(columns['trigger_id'][0], 1)
+        self.assertTrue(np.all(columns['trigger_id'][1:] == -1))
+        self.assertTrue(np.all(columns['winner_rate'] == 1510.0))
+        self.assertTrue(np.all(columns['loser_rate'] == 1490.0))
+
 
 class TestItemLabelDBController(TestCase):
     def test_get_from_blank(self):
@@ -92,3 +92,140 @@ class TestMatchingGenerator(TestCase):
             list(np.argsort(np.argsort(self.items)))
         )
         print('Intro rating based matching: %d' % cnt)
+
+    def test_incremental_gain(self):
+        result = self.comparator.match_result
+        rating = self.comparator.rating
+        generator = matching.RatingBasedMatchingGenerator(result, rating)
+        generator.attach(self.comparator)
+        next(generator)
+
+        for _ in range(15):
+            i, j = np.random.choice(self.items.shape[0], 2, replace=False)
+            self.comparator.set_match_result(i, j)
+        self.comparator.strip_match_result()
+        self.comparator.strip_match_result()
+
+        none_mask = (result == MatchResult.NONE).astype(np.int64)
+        win_mask = (result == MatchResult.WIN).astype(np.int64)
+        lose_mask = (result == MatchResult.LOSE).astype(np.int64)
+        n_win, n_lose = generator._predict_n_transitive_gain()
+        np.testing.assert_array_equal(n_win, none_mask @ win_mask.T)
+        np.testing.assert_array_equal(n_lose, none_mask @ lose_mask.T)
+
+    def test_cached_victory_probability(self):
+        result = self.comparator.match_result
+        rating = self.comparator.rating
+        generator = matching.PseudoRatingBasedMatchingGenerator(result, rating)
+        verifier = matching.PseudoRatingBasedMatchingGenerator(result, rating,
+                                                               cached=False)
+        generator._get_victory_matrix()
+
+        for _ in range(10):
+            i, j = np.random.choice(self.items.shape[0], 2, replace=False)
+            self.comparator.set_match_result(i, j)
+        self.comparator.strip_match_result()
+
+        wba = generator._get_victory_matrix()
+        self.assertEqual(wba.dtype, np.float32)
+        np.testing.assert_allclose(wba, verifier._get_victory_matrix(),
+                                   atol=1e-6)
+
+    def test_indexed_frequency_matching(self):
+        result = self.comparator.match_result
+        generator = matching.FrequencyMatchingGenerator(result)
+        generator.attach(self.comparator)
+
+        for _ in range(30):
+            try:
+                i, j = next(generator)
+            except StopIteration:
+                break
+            cnt = np.count_nonzero(result == MatchResult.NONE, axis=1)
+            matches = np.where(result == MatchResult.NONE)
+            self.assertEqual(result[i, j], MatchResult.NONE)
+            self.assertEqual(cnt[i] + cnt[j],
+                             np.max(cnt[matches[0]] + cnt[matches[1]]))
+            if self.items[i] > self.items[j]:
+                self.comparator.set_match_result(i, j)
+            else:
+                self.comparator.set_match_result(j, i)
+        self.comparator.strip_match_result()
+
+        np.testing.assert_array_equal(
+            generator._get_open_index().counts,
+            np.count_nonzero(result == MatchResult.NONE, axis=1))
+
+    def test_sampled_random_matching(self):
+        result = self.comparator.match_result
+        generator = matching.RandomMatchingGenerator(result)
+        generator.attach(self.comparator)
+        self.comparator.set_match_result(1, 0)
+        self.comparator.set_match_result(3, 2)
+
+        counts = dict()
+        for _ in range(20000):
+            i, j = next(generator)
+            self.assertEqual(result[i, j], MatchResult.NONE)
+            counts[(i, j)] = counts.get((i, j), 0) + 1
+
+        n_open = np.count_nonzero(result == MatchResult.NONE)
+        self.assertEqual(len(counts), n_open)
+        self.assertLess(max(counts.values()), 3 * 20000 / n_open)
+
+    def test_candidates(self):
+        result = self.comparator.match_result
+        rating = self.comparator.rating
+        generator = matching.RatingBasedMatchingGenerator(result, rating)
+        self.assertEqual(generator.candidates(4), [])
+
+        match = next(generator)
+        candidates = generator.candidates(4)
+        self.assertEqual(len(candidates), 4)
+        # Pairs follow the chosen one, which has the best gain
+        gain = generator._last_gain
+        self.assertTrue(all(gain[pair] <= gain[match] for pair in candidates))
+        pairs = {frozenset(pair) for pair in candidates}
+        self.assertEqual(len(pairs), 4)
+        self.assertNotIn(frozenset(match), pairs)
+
+        # Every other open pair once, in either orientation
+        n_items = self.items.shape[0]
+        candidates = generator.candidates(n_items ** 2)
+        pairs = {frozenset(pair) for pair in candidates}
+        self.assertEqual(len(candidates), n_items * (n_items - 1) // 2 - 1)
+        self.assertEqual(len(pairs), len(candidates))
+        self.assertNotIn(frozenset(match), pairs)
+
+        generator = matching.IntroRatingBasedMatchingGenerator(result, rating)
+        match = next(generator)
+        candidates = generator.candidates(4)
+        self.assertNotIn(frozenset(match), map(frozenset, candidates))
+        for i, j in candidates:
+            self.assertEqual((i - j) % self.items.shape[0], 1)
+            self.assertEqual(result[i, j], MatchResult.NONE)
+
+    def test_process_matching(self):
+        db_name = os.path.join(self.dirname, 'shared.db')
+        logger = RatedMatchResultDBController(db_name)
+        self.comparator = RatedMatchComparator(self.items.shape[0], logger,
+                                               shared=True)
+        result = self.comparator.match_result
+        generator = matching.create_matching_generator(self.comparator,
+                                                       'rating', process=True)
+        try:
+            # Candidates come back with the pair
+            match = next(generator)
+            candidates = generator.candidates(4)
+            self.assertEqual(len(candidates), 4)
+            self.assertNotIn(frozenset(match), map(frozenset, candidates))
+            self.comparison_loop(generator)
+        finally:
+            generator.close()
+            self.comparator.close()
+
+        self.assertEqual(np.count_nonzero(result == MatchResult.NONE), 0)
+        self.assertListEqual(
+            list(np.count_nonzero(result == MatchResult.WIN, axis=1)),
+            list(np.argsort(np.argsort(self.items)))
+        )
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+from unittest import TestCase
+import tempfile
+
+import numpy as np
+
+from server import comparator
+from server import db
+from server import matching
+from server.match_result import MatchResult
+from server.ranking import RankingEngine
+
+
+class TestRankingEngine(TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        db_name = os.path.join(self.dirname, 'test.db')
+        self.logger = db.RatedMatchResultDBController(db_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _assert_consistent(self, order, match_result):
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(len(order))
+        winners, losers = np.nonzero(match_result == MatchResult.WIN)
+        self.assertTrue(np.all(ranks[winners] < ranks[losers]))
+
+    def test_order(self):
+        comp = comparator.RatedMatchComparator(6, self.logger)
+        comp.set_match_result(3, 1)
+        comp.set_match_result(1, 4)
+        comp.set_match_result(5, 0)
+
+        engine = RankingEngine.from_comparator(comp)
+        self.assertEqual(engine.order[0], 3)
+        self._assert_consistent(engine.order, comp.match_result)
+
+        # Not comparable items follow their rating
+        rating = comp.rating
+        self.assertGreater(rating[5], rating[2])
+        self.assertLess(engine.ranks[5], engine.ranks[2])
+        comp.close()
+
+    def test_update(self):
+        comp = comparator.RatedMatchComparator(8, self.logger)
+        engine = RankingEngine.from_comparator(comp).attach(comp)
+
+        rng = np.random.RandomState(0)
+        for _ in range(10):
+            i, j = rng.choice(8, 2, replace=False)
+            if comp.match_result[i, j] == MatchResult.NONE:
+                comp.set_match_result(i, j)
+        comp.strip_match_result()
+
+        rebuilt = RankingEngine.from_comparator(comp)
+        np.testing.assert_array_equal(engine.wins, rebuilt.wins)
+        np.testing.assert_array_equal(engine.order, rebuilt.order)
+        self._assert_consistent(engine.order, comp.match_result)
+        comp.close()
+
+    def test_from_log(self):
+        comp = comparator.RatedMatchComparator(8, self.logger)
+        for winner, loser in [(0, 1), (1, 2), (4, 3), (2, 5), (6, 7)]:
+            comp.set_match_result(winner, loser)
+        comp.close()
+
+        engine = RankingEngine.from_log(8, self.logger, chunk_size=2)
+        expected = RankingEngine.from_comparator(comp)
+        np.testing.assert_array_equal(engine.wins, expected.wins)
+        np.testing.assert_allclose(engine.rating, expected.rating, rtol=1e-5)
+        np.testing.assert_array_equal(engine.order, expected.order)
+
+    def test_from_intro_log(self):
+        comp = comparator.RatedMatchComparator(8, self.logger)
+        # The last item as logged by the intro method before
+        comp.set_match_result(-1, 0)
+        generator = matching.IntroRatingBasedMatchingGenerator(
+                comp.match_result, comp.rating)
+        while True:
+            try:
+                i, j = next(generator)
+            except StopIteration:
+                break
+            comp.set_match_result(max(i, j), min(i, j))
+        comp.close()
+
+        engine = RankingEngine.from_log(8, self.logger, chunk_size=4)
+        expected = RankingEngine.from_comparator(comp)
+        np.testing.assert_array_equal(engine.wins, expected.wins)
+        np.testing.assert_allclose(engine.rating, expected.rating, rtol=1e-5)
+        np.testing.assert_array_equal(engine.order, np.arange(8)[::-1])
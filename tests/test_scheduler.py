@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import time
+from unittest import TestCase
+import tempfile
+
+import numpy as np
+
+from server.db import RatedMatchResultDBController
+from server.comparator import RatedMatchComparator
+from server.match_result import MatchResult
+from server import matching
+from server.scheduler import PairScheduler
+
+
+class _ListMatchingGenerator(matching.MatchingGenerator):
+    """ Given pairs in order, without candidates. """
+    def __init__(self, match_result_view, pairs):
+        super().__init__(match_result_view)
+        self._pairs = list(pairs)
+        self.n_calls = 0
+
+    def __next__(self):
+        self.n_calls += 1
+        if len(self._pairs) == 0:
+            raise StopIteration
+        return self._pairs.pop(0)
+
+
+class TestPairScheduler(TestCase):
+    def setUp(self):
+        # Sampling generators are retried a bounded number of times
+        random.seed(0)
+        np.random.seed(0)
+        self.dirname = tempfile.mkdtemp()
+        db_name = os.path.join(self.dirname, 'test.db')
+        logger = RatedMatchResultDBController(db_name)
+        self.comparator = RatedMatchComparator(12, logger)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def create_scheduler(self, method, timeout=300.0):
+        result = self.comparator.match_result
+        rating = self.comparator.rating
+        if method == 'rating':
+            generator = matching.RatingBasedMatchingGenerator(result, rating)
+        else:
+            generator = matching.FrequencyMatchingGenerator(result)
+        return PairScheduler(generator.attach(self.comparator), result,
+                             timeout)
+
+    def test_disjoint_leases(self):
+        for method in ('rating', 'freq'):
+            scheduler = self.create_scheduler(method)
+            pairs = [scheduler.lease(client) for client in range(4)]
+            items = [idx for pair in pairs for idx in pair]
+            self.assertEqual(len(set(items)), 8, msg=method)
+            for pair in pairs:
+                self.assertEqual(self.comparator.match_result[pair],
+                                 MatchResult.NONE)
+
+    def test_release(self):
+        scheduler = self.create_scheduler('rating')
+        scheduler.lease('a')
+        held = scheduler.lease('b')
+        self.assertEqual(scheduler.n_leases, 2)
+
+        # A disconnected client frees its pair
+        scheduler.release('a')
+        self.assertEqual(scheduler.n_leases, 1)
+        self.assertTrue(set(scheduler.lease('c')).isdisjoint(held))
+        self.assertEqual(scheduler.n_leases, 2)
+
+    def test_several_leases(self):
+        scheduler = self.create_scheduler('rating')
+        pairs = [scheduler.lease('a') for _ in range(3)]
+        self.assertEqual(len({frozenset(pair) for pair in pairs}), 3)
+
+        scheduler.release('a', pairs[1][::-1])
+        self.assertEqual(scheduler.n_leases, 2)
+        scheduler.release('a')
+        self.assertEqual(scheduler.n_leases, 0)
+
+    def test_expire(self):
+        scheduler = self.create_scheduler('rating', timeout=0.05)
+        scheduler.lease('a')
+        time.sleep(0.1)
+        scheduler.lease('b')
+        self.assertEqual(scheduler.n_leases, 1)
+
+    def test_answer(self):
+        scheduler = self.create_scheduler('freq')
+        leased = [scheduler.lease(client) for client in range(3)]
+        for client, (i, j) in enumerate(leased):
+            self.comparator.set_match_result(i, j)
+            scheduler.release(client, (i, j))
+            pair = scheduler.lease(client)
+            self.assertNotIn(pair, leased)
+        self.assertEqual(scheduler.n_leases, 3)
+        self.assertTrue(np.all(self.comparator.match_result[
+            tuple(np.array(leased).T)] == MatchResult.WIN))
+
+    def test_resample(self):
+        result = self.comparator.match_result
+        pairs = [(0, 1), (0, 2), (1, 3), (4, 5), (0, 3)]
+        generator = _ListMatchingGenerator(result, pairs)
+        scheduler = PairScheduler(generator, result)
+
+        self.assertEqual(scheduler.lease('a'), (0, 1))
+        self.assertEqual(generator.n_calls, 1)
+
+        # Draws stop at the first pair of free items
+        self.assertEqual(scheduler.lease('b'), (4, 5))
+        self.assertEqual(generator.n_calls, 4)
+
+        # Or when the generator runs out
+        self.assertEqual(scheduler.lease('c'), (0, 3))
+        self.assertEqual(generator.n_calls, 6)
+
+    def test_resample_limit(self):
+        result = self.comparator.match_result
+        pairs = [(0, 1)] + [(i, j) for i in (0, 1) for j in range(2, 12)]
+        generator = _ListMatchingGenerator(result, pairs)
+        scheduler = PairScheduler(generator, result)
+        scheduler.lease('a')
+        self.assertEqual(scheduler.lease('b'), (0, 2))
+        self.assertEqual(generator.n_calls, 2 + PairScheduler._N_TRIALS)
+
+    def test_resample_repeated(self):
+        result = self.comparator.match_result
+        generator = _ListMatchingGenerator(result, [(0, 1)] * 100)
+        scheduler = PairScheduler(generator, result)
+        scheduler.lease('a')
+
+        # A generator repeating itself is not sampled on
+        self.assertEqual(scheduler.lease('b'), (0, 1))
+        self.assertEqual(generator.n_calls, 3)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import asyncio
+import tempfile
+import threading
+from unittest import TestCase
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+from tornado import web, websocket, httpclient, httpserver, testing
+
+from server import db
+from server import matching
+from server.comparator import RatedMatchComparator
+from server.match_result import MatchResult
+from server.response import ImageResponseIterator
+from server.scheduler import PairScheduler
+from server.server import ThumbnailHandler, WSHandler
+from server.thumbnail import ThumbnailCache
+
+
+def _serve(app, client):
+    """ Run `client(port)` against `app` on a new IOLoop. """
+    async def run():
+        sock, port = testing.bind_unused_port()
+        server = httpserver.HTTPServer(app)
+        server.add_sockets([sock])
+        try:
+            return await client(port)
+        finally:
+            server.stop()
+    return asyncio.run(run())
+
+
+class TestThumbnailHandler(TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        names = list()
+        for i in range(3):
+            name = os.path.join(self.dirname, '%d.jpg' % i)
+            img = np.random.randint(0, 255, (120, 160, 3), dtype=np.uint8)
+            cv2.imwrite(name, img)
+            names.append(name)
+
+        logger = db.RatedMatchResultDBController(
+                os.path.join(self.dirname, 'test.db'))
+        self.comparator = RatedMatchComparator(len(names), logger)
+        generator = matching.RandomMatchingGenerator(
+                self.comparator.match_result)
+        self.cache = ThumbnailCache()
+        self.iterator = ImageResponseIterator(names, self.comparator,
+                                              generator, 40, self.cache,
+                                              protocol='url')
+        self.names = names
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        self.comparator.close()
+        shutil.rmtree(self.dirname)
+
+    def fetch(self, *paths, headers=None):
+        async def run(port):
+            client = httpclient.AsyncHTTPClient()
+            return [await client.fetch(
+                        'http://127.0.0.1:%d%s' % (port, path),
+                        headers=headers, raise_error=False)
+                    for path in paths]
+
+        app = web.Application([
+            (r'/thumb/([0-9]+)/([0-9]+)', ThumbnailHandler,
+             dict(iterator=self.iterator, executor=self.executor)),
+        ])
+        return _serve(app, run)
+
+    def test_revalidate(self):
+        res, = self.fetch('/thumb/1/40')
+        self.assertEqual(res.code, 200)
+        self.assertEqual(self.cache.stats['misses'], 1)
+
+        # The thumbnail is not read for a matching ETag
+        res, = self.fetch('/thumb/1/40',
+                          headers={'If-None-Match': res.headers['Etag']})
+        self.assertEqual(res.code, 304)
+        self.assertEqual(self.cache.stats['misses'], 1)
+        self.assertEqual(self.cache.stats['memory_hits'], 0)
+
+    def test_not_found(self):
+        # Other sizes would each add a thumbnail to the cache
+        res = self.fetch('/thumb/3/40', '/thumb/1/20')
+        self.assertEqual([r.code for r in res], [404, 404])
+        self.assertEqual(self.cache.stats['misses'], 0)
+
+    def test_intro_urls(self):
+        # The only open neighbor pair is the first and the last item
+        self.comparator.set_match_result(0, 1)
+        self.comparator.set_match_result(2, 1)
+        generator = matching.IntroRatingBasedMatchingGenerator(
+                self.comparator.match_result, self.comparator.rating)
+        iterator = ImageResponseIterator(self.names, self.comparator,
+                                         generator, 40, self.cache,
+                                         protocol='url')
+        targets = iterator.get_response()['target']
+        self.assertEqual({target['id'] for target in targets}, {0, 2})
+
+        res = self.fetch(*[target['src'] for target in targets])
+        self.assertEqual([r.code for r in res], [200, 200])
+
+
+class TestWSHandler(TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        logger = db.RatedMatchResultDBController(
+                os.path.join(self.dirname, 'test.db'))
+        self.comparator = RatedMatchComparator(6, logger)
+        result = self.comparator.match_result
+        generator = matching.RandomMatchingGenerator(result)
+        generator.attach(self.comparator)
+        self.iterator = ImageResponseIterator(
+                ['%d.jpg' % i for i in range(6)], self.comparator, generator,
+                protocol='url', scheduler=PairScheduler(generator, result))
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        self.comparator.close()
+        shutil.rmtree(self.dirname)
+
+    def app(self, iterator, lock):
+        return web.Application([
+            (r'/ws', WSHandler, dict(iterator=iterator,
+                                     comparator=self.comparator,
+                                     executor=self.executor, lock=lock)),
+        ])
+
+    def test_undo_own_answer(self):
+        async def run(port):
+            url = 'ws://127.0.0.1:%d/ws' % port
+            a = await websocket.websocket_connect(url)
+            b = await websocket.websocket_connect(url)
+            await a.read_message()
+            await b.read_message()
+            for conn, (winner, loser) in ((a, (1, 0)), (b, (3, 2))):
+                conn.write_message(json.dumps(
+                        dict(action='select', winner=winner, loser=loser)))
+                await conn.read_message()
+
+            # Only the answer of `a` is undone, although `b` answered last
+            a.write_message(json.dumps(dict(action='undo')))
+            await a.read_message()
+            a.close()
+            b.close()
+
+        _serve(self.app(self.iterator, threading.Lock()), run)
+
+        result = self.comparator.match_result
+        self.assertEqual(result[1, 0], MatchResult.NONE)
+        self.assertEqual(result[3, 2], MatchResult.WIN)
+
+    def test_thumbnails_unlocked(self):
+        lock = threading.Lock()
+        locked = list()
+        generator = matching.RandomMatchingGenerator(
+                self.comparator.match_result)
+        iterator = ImageResponseIterator(
+                ['%d.jpg' % i for i in range(6)], self.comparator, generator)
+        iterator._get_thumbnail = lambda idx: locked.append(lock.locked())
+
+        async def run(port):
+            conn = await websocket.websocket_connect(
+                    'ws://127.0.0.1:%d/ws' % port)
+            res = json.loads(await conn.read_message())
+            winner, loser = [target['id'] for target in res['target']]
+            conn.write_message(json.dumps(
+                    dict(action='select', winner=winner, loser=loser)))
+            await conn.read_message()
+            conn.close()
+
+        _serve(self.app(iterator, lock), run)
+        # Other connections answer while thumbnails are made
+        self.assertEqual(locked, [False] * 4)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+from unittest import TestCase
+import tempfile
+
+import numpy as np
+import cv2
+
+from server import thumbnail
+from server.thumbnail import ThumbnailCache
+
+
+class TestThumbnailCache(TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.names = list()
+        for i in range(3):
+            name = os.path.join(self.dirname, '%d.jpg' % i)
+            img = np.random.randint(0, 255, (120, 160, 3), dtype=np.uint8)
+            cv2.imwrite(name, img)
+            self.names.append(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_reduced_decode(self):
+        self.assertEqual(thumbnail._probe_jpeg_size(self.names[0]),
+                         (120, 160))
+        png_name = os.path.join(self.dirname, 'a.png')
+        cv2.imwrite(png_name, np.zeros((12, 16, 3), dtype=np.uint8))
+        self.assertIsNone(thumbnail._probe_jpeg_size(png_name))
+
+        self.assertEqual(thumbnail._get_imread_flag(self.names[0], 40),
+                         cv2.IMREAD_REDUCED_COLOR_4)
+        self.assertEqual(thumbnail._get_imread_flag(self.names[0], 100),
+                         cv2.IMREAD_COLOR)
+        self.assertEqual(thumbnail._get_imread_flag(png_name, 4),
+                         cv2.IMREAD_COLOR)
+
+    def test_memory_cache(self):
+        cache = ThumbnailCache()
+        data = cache.get(self.names[0], 40)
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        self.assertEqual(img.shape, (30, 40, 3))
+
+        self.assertIs(cache.get(self.names[0], 40), data)
+        cache.get(self.names[0], 80)
+        stats = cache.stats
+        self.assertEqual(stats['memory_hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_eviction(self):
+        size = len(ThumbnailCache().get(self.names[0], 100))
+        cache = ThumbnailCache(max_bytes=int(size * 2.5))
+        for name in self.names:
+            cache.get(name, 100)
+        self.assertEqual(cache.stats['n_items'], 2)
+
+        # The least recently used one was evicted
+        cache.get(self.names[0], 100)
+        self.assertEqual(cache.stats['misses'], 4)
+
+    def test_disk_cache(self):
+        thumb_dir = os.path.join(self.dirname, 'thumbs')
+        data = ThumbnailCache(dirname=thumb_dir).get(self.names[1], 50)
+
+        cache = ThumbnailCache(dirname=thumb_dir)
+        self.assertEqual(cache.get(self.names[1], 50), data)
+        self.assertEqual(cache.stats['disk_hits'], 1)
+
+        # A modified image is not served from the cache
+        digest = cache.get_digest(self.names[1], 50)
+        stat = os.stat(self.names[1])
+        cv2.imwrite(self.names[1], np.zeros((120, 160, 3), dtype=np.uint8))
+        os.utime(self.names[1], ns=(stat.st_atime_ns,
+                                    stat.st_mtime_ns + 10 ** 9))
+        cache.get(self.names[1], 50)
+        self.assertEqual(cache.stats['misses'], 1)
+        self.assertNotEqual(cache.get_digest(self.names[1], 50), digest)
+
+    def test_precompute(self):
+        thumb_dir = os.path.join(self.dirname, 'thumbs')
+        stats = thumbnail.precompute_thumbnails(self.names, [40, 80],
+                                                thumb_dir, 'webp', 2)
+        self.assertEqual(stats['n_created'], 6)
+
+        # Resumes without writing again
+        stats = thumbnail.precompute_thumbnails(self.names, [40, 80],
+                                                thumb_dir, 'webp', 2)
+        self.assertEqual(stats['n_created'], 0)
+
+        # Content addressed, so a copy of an image is served as well
+        copied = os.path.join(self.dirname, 'copy.jpg')
+        shutil.copy(self.names[2], copied)
+        cache = ThumbnailCache(dirname=thumb_dir, fmt='webp')
+        data = cache.get(copied, 80)
+        self.assertEqual(cache.stats['disk_hits'], 1)
+        self.assertEqual(data[8:12], b'WEBP')